@@ -1,114 +1,864 @@
 import pandas as pd
 import numpy as np
+import os
 import time
 import argparse
-from tqdm import tqdm
-from helpers import (determine_job_type, check_shared_buyin)
-import datetime
+import glob
+import shutil
+import tempfile
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor
+from metrics import StageMetrics
+from backends import select_first_jobs_arrow, select_first_jobs_polars
+from helpers import (read_accounting, stream_accounting, iter_accounting_tables, determine_job_type,
+                     check_shared_buyin, submission_calendar, read_waiting_times, str_contains, merge_latest_end_times,
+                     collapse_array_tasks, earlier_years_file, OUTPUT_DTYPES, ALL_JOB_DTYPES, ARRAY_DTYPES,
+                     STATE_COLUMNS, DATASET_DIR)
 
+INPUT_FILE_TEMPLATE = '/projectnb/rcsmetrics/accounting/data/scc/{year}.feather'
+OUTPUT_FILE_TEMPLATE = '/projectnb/rcs-intern/Jiazheng/accounting/waiting_times_{year}_per_job_type.csv'
+STATE_FILE_TEMPLATE = '/projectnb/rcs-intern/Jiazheng/accounting/waiting_times_{year}_state.feather'
 
-def waiting_time_per_job_type(input_file_name, output_file_name, year):
-    # Read data from the Feather file
-    df = pd.read_feather(input_file_name)
+# Outputs the same scan can write besides the first-job waiting times. The queue percentiles and owner counts are
+# summaries of the whole year's all-job waiting times, so they come with the all_jobs output
+EXTRA_OUTPUT_TEMPLATES = {
+    'all_jobs': '/projectnb/rcs-intern/Jiazheng/accounting/waiting_times_{year}_all_jobs.csv',
+    'queue_percentiles': '/projectnb/rcs-intern/Jiazheng/accounting/waiting_times_{year}_queue_percentiles.csv',
+    'owner_counts': '/projectnb/rcs-intern/Jiazheng/accounting/waiting_times_{year}_owner_counts.csv',
+}
+ALL_JOBS_DATASET_DIR = '/projectnb/rcs-intern/Jiazheng/accounting/all_job_waiting_times_dataset'
+QUEUE_PERCENTILES = [50, 75, 90, 95, 99]
 
-    # filter cols we need
-    df = df[['ux_submission_time', 'ux_start_time', 'ux_end_time', 'granted_pe', 'slots', 'options', 'pe_taskid', 'qname', 'job_number', 'owner', 'job_name', 'task_number']]
-    # remove records: 'mpi' exist in granted_pe and its pe_taskid column has a valid value
-    df = df[~((df['granted_pe'].str.contains('mpi', na=False)) & (df['pe_taskid'].notna() & df['pe_taskid'].ne('None')))]
-    
+# Where owner shards are handed to the worker processes: tmpfs, so the Arrow files never touch the disk
+SHARED_MEMORY_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def owner_job_groups(df):
+    """
+    Number the (owner, job_type) group of every row. Returns the group number
+    of each row and a DataFrame with the owner/job_type of each group number.
+    """
+    owner_codes, owners = pd.factorize(df['owner'], use_na_sentinel=False)
+    type_codes, job_types = pd.factorize(df['job_type'], use_na_sentinel=False)
+    n_types = max(len(job_types), 1)
+    groups, pairs = pd.factorize(owner_codes.astype(np.int64) * n_types + type_codes)
+    keys = pd.DataFrame({
+        'owner': np.asarray(owners, dtype=object)[pairs // n_types],
+        'job_type': np.asarray(job_types, dtype=object)[pairs % n_types],
+    })
+    return groups, keys
+
+
+def first_job_flags(df, latest_end_times=None):
+    """
+    Flag the "first jobs" of a DataFrame already sorted by ux_end_time.
+
+    A job is a first job when it was submitted after every earlier job of the
+    same (owner, job_type) had ended.  This is the columnar equivalent of
+    walking the rows while keeping a dict of latest end times: the latest end
+    time seen *before* each row is the running max of ux_end_time within its
+    group, shifted down by one row.
+
+    latest_end_times carries that dict over from earlier records (a DataFrame
+    with STATE_COLUMNS). Returns the flags and the updated latest_end_times.
+    """
+    groups, keys = owner_job_groups(df)
+    end_time = pd.Series(df['ux_end_time'].to_numpy())
+    latest_end = end_time.groupby(groups).cummax().groupby(groups).shift(1, fill_value=0).to_numpy()
+
+    carried = np.zeros(len(keys), dtype=np.int64)
+    if latest_end_times is not None and len(latest_end_times):
+        carried = (keys.merge(latest_end_times, on=['owner', 'job_type'], how='left')['latest_end_time']
+                   .fillna(0).to_numpy(dtype=np.int64))
+    latest_end = np.maximum(latest_end, carried[groups])
+
+    keys['latest_end_time'] = np.maximum(carried, end_time.groupby(groups).max().to_numpy(dtype=np.int64))
+    return df['ux_submission_time'].to_numpy() > latest_end, merge_latest_end_times(latest_end_times, keys)
+
+
+def load_state(state_file_name):
+    """
+    Load the state saved by save_state: latest_end_times, the high-water mark
+    on ux_end_time and the size of the output file when the state was saved.
+    """
+    table = feather.read_table(state_file_name)
+    metadata = table.schema.metadata
+    return table.to_pandas(), int(metadata[b'watermark']), int(metadata[b'output_size'])
+
+
+def load_output_size(state_file_name, name):
+    # Size of the all_jobs or earlier_years output when the state was saved, None if the run that saved it did not
+    # write one
+    size = feather.read_table(state_file_name, columns=[]).schema.metadata.get(f'{name}_size'.encode())
+    return None if size is None else int(size)
+
+
+def owner_counts_state_file(state_file_name):
+    # Where the owner_counts summary of the jobs up to the state's watermark is kept for the next run
+    root, ext = os.path.splitext(state_file_name)
+    return f'{root}_owner_counts{ext}'
+
+
+def load_owner_counts(state_file_name, watermark):
+    # The owner_counts saved with the state, None if there is none or it was saved at another watermark
+    file_name = owner_counts_state_file(state_file_name)
+    if not os.path.exists(file_name):
+        return None
+    table = feather.read_table(file_name)
+    if int(table.schema.metadata[b'watermark']) != watermark:
+        return None
+    return table.to_pandas()
+
+
+def save_state(state_file_name, latest_end_times, watermark, output_size, all_jobs_size=None, owner_counts=None,
+               earlier_years_size=None):
+    # Write to a temporary file and rename it, so a killed job never leaves a half-written state behind
+    if owner_counts is not None:
+        # Saved first and tagged with the watermark: if the state below is never written, it is not used
+        counts_file_name = owner_counts_state_file(state_file_name)
+        feather.write_feather(pa.Table.from_pandas(owner_counts, preserve_index=False).replace_schema_metadata(
+            {'watermark': str(watermark)}), counts_file_name + '.tmp')
+        os.replace(counts_file_name + '.tmp', counts_file_name)
+    table = pa.Table.from_pandas(latest_end_times[STATE_COLUMNS], preserve_index=False)
+    metadata = {'watermark': str(watermark), 'output_size': str(output_size)}
+    if all_jobs_size is not None:
+        metadata['all_jobs_size'] = str(all_jobs_size)
+    if earlier_years_size is not None:
+        metadata['earlier_years_size'] = str(earlier_years_size)
+    table = table.replace_schema_metadata(metadata)
+    feather.write_feather(table, state_file_name + '.tmp')
+    os.replace(state_file_name + '.tmp', state_file_name)
+
+
+def prepare_jobs(df, verbose=True, metrics=None):
+    """
+    Classify, queue-map and sort accounting records, and add their submission
+    year, month and day. A yearly file holds the jobs that ended in its year,
+    so the jobs submitted before it are there too, with their own year:
+    waiting_time_per_job_type writes them to earlier_years_file.
+    """
+    metrics = metrics or StageMetrics()
     # df['job_type'] = df.apply(determine_job_type, axis=1)
-    print('Total jobs:', len(df))
-    df = determine_job_type(df)
-    print('after determined job type:', len(df))
-    print(pd.crosstab(index=df.job_type, columns="count"))
-    df = check_shared_buyin(df)
-    df.sort_values(by='ux_end_time', inplace=True)
-    print('after sorting by ending_time:', pd.crosstab(index=df.job_type, columns="count"))
-
-    # Ensure the time columns are integers
-    df['ux_submission_time'] = df['ux_submission_time'].astype(int)
-    df['ux_start_time'] = df['ux_start_time'].astype(int)
-    df['ux_end_time'] = df['ux_end_time'].astype(int)
-    df['year'] = year
-
-    
-    latest_end_times = {} # Initialize a dictionary to track the latest end time for each (owner, job_type)
-    job_type_waiting_times = [] # Initialize a list to store waiting times
-
-    for index, row in tqdm(df.iterrows(), total=len(df), desc="Processing jobs"):
-        submission_time = row['ux_submission_time']
-        start_time = row['ux_start_time']
-        end_time = row['ux_end_time']
-        owner = row['owner']
-        job_type = row['job_type']
-        qname = row['qname']
-        initialYear = datetime.datetime.fromtimestamp(submission_time).year
-
-        # Only process jobs from the specified year
-        if initialYear == year:
-            month = datetime.datetime.fromtimestamp(submission_time).strftime('%b')
-            day = datetime.datetime.fromtimestamp(submission_time).day  # Extract 1–31
-
-            # Initialize the latest end time for this (owner, job_type) if not already set
-            if (owner, job_type) not in latest_end_times:
-                latest_end_times[(owner, job_type)] = 0
-
-            # Check if this job is a "first job" (submission_time > latest_end_time)
-            if submission_time > latest_end_times[(owner, job_type)]:
-                current_waiting_time = start_time - submission_time
-                if current_waiting_time >= 0:
-                    # Determine job_type_label based on job_type and qname
-                    if job_type == 'GPU':
-                        if 'gpus=1' in row['options']:
-                            job_type_label = f'GPU = 1 {qname}'
-                        else:
-                            job_type_label = f'GPU > 1 {qname}'
-                    elif job_type == 'MPI':
-                        job_type_label = f'MPI job {qname}'
-                    else:
-                        job_type_label = f'{job_type} {qname}'
-
-                    # Append the result
-                    job_type_waiting_times.append([
-                        job_type_label,
-                        row['class_user'],
-                        row['class_own'],
-                        current_waiting_time,
-                        month,
-                        year,
-                        day,
-                        row['job_number'],
-                        row['slots']
-                    ])
-
-            # Update the latest end time for this (owner, job_type)
-            latest_end_times[(owner, job_type)] = max(end_time, latest_end_times[(owner, job_type)])
-
-    # Convert the results to a DataFrame
-    job_type_waiting_df = pd.DataFrame(job_type_waiting_times, columns=['job_type', 'class_user', 'class_own', 'first_job_waiting_time', 'month', 'year', 'day', 'job_number', 'slots'])
-
-    # Save the results to a CSV file
-    job_type_waiting_df.to_csv(output_file_name, index=False, chunksize=100000)
-    
+    if verbose:
+        print('Total jobs:', len(df))
+    with metrics.stage('classify', rows_in=len(df)) as stage:
+        df = determine_job_type(df)
+        stage['rows_out'] = len(df)
+    if verbose:
+        print('after determined job type:', len(df))
+        print(pd.crosstab(index=df.job_type, columns="count"))
+    with metrics.stage('queue_mapping', rows_in=len(df)) as stage:
+        df = check_shared_buyin(df)
+        stage['rows_out'] = len(df)
+    with metrics.stage('sort', rows_in=len(df)) as stage:
+        df.sort_values(by='ux_end_time', kind='stable', inplace=True)  # ties keep file order, so reruns agree
+
+        # Ensure the time columns are integers
+        df['ux_submission_time'] = df['ux_submission_time'].astype(int)
+        df['ux_start_time'] = df['ux_start_time'].astype(int)
+        df['ux_end_time'] = df['ux_end_time'].astype(int)
+        stage['rows_out'] = len(df)
+    if verbose:
+        print('after sorting by ending_time:', pd.crosstab(index=df.job_type, columns="count"))
+
+    with metrics.stage('calendar', rows_in=len(df)) as stage:
+        # Split every submission time into local year/month/day in one pass
+        calendar = submission_calendar(df['ux_submission_time'])
+
+        # Assign the arrays, not the Series: an empty batch would be re-indexed to the calendar
+        df = df.assign(year=calendar['year'].array, month=calendar['month'].array,
+                       day=calendar['day'].array)  # day is 1–31
+        stage['rows_out'] = len(df)
+    return df
+
+
+def previous_year_end_times(previous_input_file_name, batch_rows=None):
+    """
+    latest_end_times of the whole accounting file of the year before, which
+    the scan of a year starts from. Every job in it ended before the jobs of
+    this year's file, so it only matters to the jobs submitted before the
+    year (see earlier_years_file). Read in batches of batch_rows rows, if given.
+    """
+    columns = ['owner', 'options', 'slots', 'granted_pe', 'ux_end_time']
+    tables = iter_accounting_tables(previous_input_file_name, batch_rows, columns) if batch_rows else \
+        [read_accounting(previous_input_file_name, columns, as_table=True)]
+    latest_end_times = None
+    for table in tables:
+        df = determine_job_type(table.to_pandas())
+        keys = (df.groupby(['owner', 'job_type'], observed=True, sort=False)['ux_end_time'].max()
+                .rename('latest_end_time').reset_index())
+        latest_end_times = merge_latest_end_times(latest_end_times, keys.astype(
+            {'owner': object, 'job_type': object, 'latest_end_time': np.int64}))
+    return latest_end_times
+
+
+def read_batches(input_file_name, batch_rows=None, min_end_time=None, as_table=False):
+    # Accounting records as DataFrames (Arrow tables with as_table): one per stream_accounting batch, or the whole
+    # file at once
+    if batch_rows:
+        yield from stream_accounting(input_file_name, batch_rows, min_end_time=min_end_time, as_table=as_table)
+    else:
+        yield read_accounting(input_file_name, min_end_time=min_end_time, as_table=as_table)
+
+
+def timed_batches(batches, metrics):
+    # Time the reads of a lazy batch iterator (e.g. stream_accounting) as the 'read' stage
+    iterator = iter(batches)
+    while True:
+        with metrics.stage('read') as stage:
+            df = next(iterator, None)
+            stage['rows_out'] = 0 if df is None else len(df)
+        if df is None:
+            return
+        yield df
+
+
+def select_first_jobs(df, latest_end_times=None, all_jobs=False):
+    """
+    Keep the first jobs of df (the output of prepare_jobs) that have a valid
+    waiting time. Every job of df goes into the
+    scan and the updated latest_end_times, which are returned with them.
+    With all_jobs, every such job is kept instead, and a first_job column
+    flags the first jobs.
+    """
+    # Flag "first jobs" (submission_time > latest end time of the owner's earlier jobs of this type)
+    first_job, latest_end_times = first_job_flags(df, latest_end_times)
+    output = (df['ux_start_time'] >= df['ux_submission_time']).to_numpy()
+    if all_jobs:
+        return df[output].assign(first_job=first_job[output]), latest_end_times
+    return df[first_job & output], latest_end_times
+
+
+def select_first_jobs_pandas(df, latest_end_times=None, metrics=None, verbose=True, all_jobs=False):
+    # prepare_jobs + select_first_jobs: the reference implementation the other BACKENDS are checked against
+    metrics = metrics or StageMetrics()
+    df = prepare_jobs(df, verbose=verbose, metrics=metrics)
+    with metrics.stage('first_job_scan', rows_in=len(df)) as stage:
+        first_jobs, latest_end_times = select_first_jobs(df, latest_end_times, all_jobs)
+        stage['rows_out'] = len(first_jobs)
+    return first_jobs, latest_end_times
+
+
+# DataFrame libraries the first-job scan can run on. All of them return the same first jobs (a pandas DataFrame)
+# and latest_end_times; pandas takes DataFrame batches, the others Arrow tables (see benchmarks/check_backends.py)
+BACKENDS = {
+    'pandas': select_first_jobs_pandas,
+    'arrow': select_first_jobs_arrow,
+    'polars': select_first_jobs_polars,
+}
+
+
+def split_earlier_years(rows, year):
+    # The output rows of jobs submitted before year (see earlier_years_file) and of those submitted in year. Jobs
+    # submitted after year are only seen when the local timezone is not the one the files were split in
+    years = rows['year'].to_numpy()
+    return rows[years < year].reset_index(drop=True), rows[years == year].reset_index(drop=True)
+
+
+def waiting_time_rows(df):
+    # Build the output rows for the first jobs picked by select_first_jobs
+    # GPU jobs are split by the number of GPUs asked for; the other job classes have no gpu_bucket
+    gpu = df['job_type'].eq('GPU').to_numpy()
+    single_gpu = str_contains(df['options'], 'gpus=1')
+    gpu_bucket_codes = np.where(gpu, np.where(single_gpu, 0, 1), -1)
+
+    rows = pd.DataFrame({
+        'job_class': df['job_type'],
+        'gpu_bucket': pd.Categorical.from_codes(gpu_bucket_codes, dtype=OUTPUT_DTYPES['gpu_bucket']),
+        'qname': df['qname'],
+        'class_user': df['class_user'],
+        'class_own': df['class_own'],
+        'first_job_waiting_time': df['ux_start_time'] - df['ux_submission_time'],
+        'month': df['month'],
+        'year': df['year'],
+        'day': df['day'],
+        'job_number': df['job_number'],
+        'slots': df['slots'],
+    }).reset_index(drop=True).astype(OUTPUT_DTYPES)
+    if 'tasks' in df.columns:
+        # Array jobs collapsed by collapse_array_tasks
+        rows = rows.assign(tasks=df['tasks'].to_numpy(),
+                           last_task_waiting_time=(df['ux_last_start_time'] - df['ux_submission_time']).to_numpy()
+                           ).astype(ARRAY_DTYPES)
+    return rows
+
+
+def all_job_rows(df):
+    # The all_jobs output rows (ALL_JOB_DTYPES) for the jobs returned by select_first_jobs with all_jobs
+    return (waiting_time_rows(df).rename(columns={'first_job_waiting_time': 'waiting_time'})
+            .assign(owner=df['owner'].to_numpy(), first_job=df['first_job'].to_numpy()).astype(ALL_JOB_DTYPES))
+
+
+def queue_wait_percentiles(all_jobs):
+    """
+    Waiting time percentiles (QUEUE_PERCENTILES, in seconds) of all jobs and
+    of first jobs per (qname, job_class), with the number of jobs of each.
+    """
+    groups = ['qname', 'job_class']
+    summaries = []
+    for prefix, jobs in [('', all_jobs), ('first_job_', all_jobs[all_jobs['first_job']])]:
+        waits = jobs.groupby(groups, observed=True)['waiting_time']
+        summary = waits.quantile([p / 100 for p in QUEUE_PERCENTILES]).unstack()
+        summary.columns = [f'{prefix}p{p}' for p in QUEUE_PERCENTILES]
+        summaries.append(pd.concat([waits.size().rename(f'{prefix}jobs'), summary], axis=1))
+    return pd.concat(summaries, axis=1).fillna({'first_job_jobs': 0}).astype({'first_job_jobs': int}).reset_index()
+
+
+def owner_job_counts(all_jobs):
+    # Jobs and first jobs per (owner, job_class, month) with their total waiting time in seconds
+    waits = all_jobs.assign(waiting_time=all_jobs['waiting_time'].astype(np.int64))  # no overflow
+    return (waits.groupby(['owner', 'job_class', 'month'], observed=True)
+            .agg(jobs=('first_job', 'size'), first_jobs=('first_job', 'sum'),
+                 total_waiting_time=('waiting_time', 'sum'))
+            .reset_index())
+
+
+def merge_owner_counts(*counts):
+    # Add up owner_job_counts summaries of different jobs, e.g. of the batches of a run
+    keys = ['owner', 'job_class', 'month']
+    counts = [c for c in counts if c is not None and len(c)] or [c for c in counts if c is not None][:1]
+    merged = pd.concat(counts, ignore_index=True).astype(
+        {'owner': 'category', 'job_class': ALL_JOB_DTYPES['job_class'], 'month': ALL_JOB_DTYPES['month']})
+    return merged.groupby(keys, observed=True)[['jobs', 'first_jobs', 'total_waiting_time']].sum().reset_index()
+
+
+def write_summary(summary, file_name):
+    if file_name.endswith('.feather'):
+        summary.to_feather(file_name)
+    else:
+        summary.to_csv(file_name, index=False)
+
+
+def write_summaries(all_jobs_file_name, extra_outputs, year, metrics):
+    """
+    Write the queue_percentiles summary from the year's all_jobs output, which
+    after a resumed or checkpointed run holds the jobs of every earlier run
+    too, so the percentiles always cover the whole year. Percentiles cannot
+    be added up from batches like owner_counts, so this reads every all_jobs
+    row of the year; the nightly job leaves it to the backfill.
+    """
+    with metrics.stage('summaries') as stage:
+        all_jobs = read_waiting_times(all_jobs_file_name, year, dtypes=ALL_JOB_DTYPES)
+        write_summary(queue_wait_percentiles(all_jobs), extra_outputs['queue_percentiles'])
+        stage['rows_in'] = len(all_jobs)
+
+
+def extra_output_files(names, year):
+    # {name: file name} of the extra outputs of a year, with the all_jobs output the summaries are made from
+    return {name: EXTRA_OUTPUT_TEMPLATES[name].format(year=year) for name in ['all_jobs', *names]} if names else {}
 
 
+def default_workers():
+    # Use the slots SGE granted us (NSLOTS), otherwise every core of the node
+    return int(os.environ.get('NSLOTS', os.cpu_count() or 1))
+
+
+def owner_shards(owners, n_shards):
+    # Shard number of every owner: a hash that is the same in every process and every run (unlike hash())
+    codes, uniques = pd.factorize(np.asarray(owners, dtype=object), use_na_sentinel=False)
+    shard_of_owner = pd.util.hash_array(np.asarray(uniques, dtype=object)) % np.uint64(n_shards)
+    return shard_of_owner.astype(np.int64)[codes]
+
+
+def write_arrow(table, file_name):
+    with pa.OSFile(file_name, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def read_arrow(file_name):
+    # Memory-mapped, so a table written to SHARED_MEMORY_DIR is read without copying it
+    return pa.ipc.open_file(pa.memory_map(file_name)).read_all()
+
+
+def scan_owner_shard(df, latest_end_times=None, metrics=None):
+    """
+    prepare_jobs and select_first_jobs for the records of some owners, e.g.
+    one owner shard of a batch, whose index is their row number in the batch.
+    Returns an Arrow table of the output rows with their row number and end
+    time (see merge_shard_results) and the updated latest_end_times of these
+    owners.
+    """
+    first_jobs, latest_end_times = select_first_jobs_pandas(df, latest_end_times, metrics, verbose=False)
+    result = pa.Table.from_pandas(waiting_time_rows(first_jobs), preserve_index=False)
+    for name, column in zip(['row', 'ux_end_time'], [first_jobs.index, first_jobs['ux_end_time']]):
+        result = result.append_column(name, pa.array(np.asarray(column, dtype=np.int64)))
+    return result, latest_end_times
+
+
+def merge_shard_results(results):
+    """
+    Merge the scan_owner_shard results of all the shards of a batch (as
+    DataFrames) in ux_end_time order, ties in batch order, which is the order
+    a single scan gives. Returns the output rows.
+    """
+    if results:
+        merged = pd.concat(results, ignore_index=True)
+        merged = merged.iloc[np.lexsort((merged['row'].to_numpy(), merged['ux_end_time'].to_numpy()))]
+    else:
+        merged = pd.DataFrame(columns=list(OUTPUT_DTYPES))
+    dtypes = {**OUTPUT_DTYPES, **ARRAY_DTYPES} if 'tasks' in merged.columns else OUTPUT_DTYPES
+    return merged[list(dtypes)].reset_index(drop=True).astype(dtypes)
+
+
+def scan_shard(shard_file_name, state_file_name):
+    """
+    Worker side of select_first_jobs_sharded: scan_owner_shard on a shard
+    handed over in shared memory, with the result and the shard's state
+    written next to it. Returns the stage records of the worker's StageMetrics.
+    """
+    metrics = StageMetrics()
+    df = read_arrow(shard_file_name).to_pandas(split_blocks=True, self_destruct=True)
+    df.index = df.pop('row')
+    result, latest_end_times = scan_owner_shard(df, read_arrow(state_file_name).to_pandas(), metrics)
+    write_arrow(result, shard_file_name + '.result')
+    write_arrow(pa.Table.from_pandas(latest_end_times[STATE_COLUMNS], preserve_index=False),
+                state_file_name + '.result')
+    return list(metrics.stages.values())
+
+
+def select_first_jobs_sharded(table, latest_end_times, executor, n_shards, metrics):
+    """
+    Sharded equivalent of prepare_jobs + select_first_jobs + waiting_time_rows
+    for an Arrow table of accounting records. Whether a job is a first job
+    only depends on the history of its (owner, job_type), so the records are
+    split by owner hash into n_shards shards that are scanned in parallel by
+    executor. Shards go to the workers as Arrow files in shared memory
+    (SHARED_MEMORY_DIR) instead of being pickled.
+
+    The shard outputs are merged back by merge_shard_results. Returns the
+    output rows and the updated latest_end_times. The worker stages
+    are added to metrics summed over the shards (so in CPU seconds), with
+    the largest worker peak RSS.
+    """
+    if latest_end_times is None:
+        latest_end_times = merge_latest_end_times()
+    state_shards = owner_shards(latest_end_times['owner'], n_shards)
+    shard = owner_shards(table['owner'].to_numpy(zero_copy_only=False), n_shards)
+    order = np.argsort(shard, kind='stable')
+    bounds = np.searchsorted(shard[order], np.arange(n_shards + 1))
+    table = table.append_column('row', pa.array(np.arange(table.num_rows))).take(order)
+
+    with tempfile.TemporaryDirectory(prefix='waiting_times_shards_', dir=SHARED_MEMORY_DIR) as shard_dir:
+        futures, states = {}, []
+        for i in range(n_shards):
+            state = latest_end_times[state_shards == i]
+            if bounds[i] == bounds[i + 1]:
+                states.append(state)  # no records of these owners in this batch
+                continue
+            shard_file_name = os.path.join(shard_dir, f'shard_{i}.arrow')
+            state_file_name = os.path.join(shard_dir, f'state_{i}.arrow')
+            write_arrow(table.slice(bounds[i], bounds[i + 1] - bounds[i]), shard_file_name)
+            write_arrow(pa.Table.from_pandas(state[STATE_COLUMNS].astype({'latest_end_time': np.int64}),
+                                             preserve_index=False), state_file_name)
+            futures[executor.submit(scan_shard, shard_file_name, state_file_name)] = \
+                (shard_file_name, state_file_name)
+        del table
+
+        results = []
+        for future, (shard_file_name, state_file_name) in futures.items():
+            for record in future.result():
+                metrics.add(record['stage'], record['seconds'], record['rows_in'], record['rows_out'],
+                            record['process_peak_rss_mb'])
+            results.append(read_arrow(shard_file_name + '.result').to_pandas())
+            states.append(read_arrow(state_file_name + '.result').to_pandas())
+
+    return merge_shard_results(results), merge_latest_end_times(*states)
+
+
+def is_dataset(output_file_name):
+    # Outputs without a .csv or .feather extension are Hive-partitioned Parquet dataset directories
+    return not output_file_name.endswith(('.csv', '.feather'))
+
+
+def output_size(output_file_name):
+    # Dataset parts are tracked by name (see waiting_time_per_job_type), not by size
+    return 0 if is_dataset(output_file_name) else os.path.getsize(output_file_name)
+
+
+def write_dataset(job_type_waiting_df, output_file_name, part_name):
+    """
+    Add the rows to a Parquet dataset partitioned as year=/month=/job_class=,
+    where job_class is GPU, MPI, OMP or 1-p. Every call writes new files named
+    after part_name, with min/max statistics for every column, so readers
+    can skip whole partitions and row groups.
+    """
+    table = pa.Table.from_pandas(job_type_waiting_df, preserve_index=False)
+    ds.write_dataset(
+        table, output_file_name, format='parquet',
+        partitioning=['year', 'month', 'job_class'], partitioning_flavor='hive',
+        basename_template=f'{part_name}-{{i}}.parquet',
+        existing_data_behavior='overwrite_or_ignore',
+        file_options=ds.ParquetFileFormat().make_write_options(compression='zstd', write_statistics=True),
+    )
+
+
+def remove_parts(output_file_name, year, prefix=''):
+    # Remove a year's dataset files whose names start with prefix (all of them by default)
+    if not prefix:
+        shutil.rmtree(os.path.join(output_file_name, f'year={year}'), ignore_errors=True)
+        return
+    for path in glob.glob(os.path.join(output_file_name, f'year={year}', '*', '*', f'{prefix}*.parquet')):
+        os.remove(path)
+
+
+def outdated_columns(output_file_name, year):
+    """
+    Columns of an output written before LABEL_COLUMNS existed (job_type), or
+    of an all_jobs output written before it had waiting_time
+    (first_job_waiting_time): rows with the new columns cannot be appended
+    to it.
+    """
+    if is_dataset(output_file_name):
+        paths = glob.glob(os.path.join(output_file_name, f'year={year}', '*', '*', '*.parquet'))
+        names = pq.read_schema(paths[0]).names if paths else []
+    elif output_file_name.endswith('.csv'):
+        with open(output_file_name) as output_file:
+            names = output_file.readline().rstrip('\n').split(',')
+    else:
+        return []  # appending to a Feather file copies it with read_waiting_times, which converts them
+    outdated = ['job_type'] if 'job_type' in names else []
+    if 'first_job' in names and 'first_job_waiting_time' in names:
+        outdated.append('first_job_waiting_time')
+    return outdated
+
+
+class FeatherOutput:
+    """
+    A Feather output written batch by batch through one Arrow IPC writer, into
+    a temporary file that commit() renames over the output. Categorical
+    columns keep one growing list of categories, so a batch only adds a
+    dictionary delta for its new values. When appending, the rows already in
+    the output are copied into the writer once, before the first batch.
+    """
+
+    def __init__(self, output_file_name, append=False):
+        self.output_file_name = output_file_name
+        self.append = append
+        self.writer, self.schema, self.categories = None, None, {}
+
+    def open(self, df):
+        # Start the temporary file with the schema of df, which fixes the dictionary index type
+        self.categories = {column: [] for column, dtype in df.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)}
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        self.schema = pa.schema([field.with_type(pa.dictionary(pa.int32(), pa.string(), field.type.ordered))
+                                 if pa.types.is_dictionary(field.type) else field for field in schema],
+                                metadata=schema.metadata)
+        self.writer = pa.ipc.new_file(self.output_file_name + '.tmp', self.schema,
+                                      options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+        if self.append and os.path.exists(self.output_file_name):
+            dtypes = ALL_JOB_DTYPES if 'first_job' in df.columns else OUTPUT_DTYPES
+            if 'tasks' in df.columns:
+                dtypes = {**dtypes, **ARRAY_DTYPES}
+            self.write(read_waiting_times(self.output_file_name, dtypes=dtypes)[list(df.columns)])
+
+    def write(self, df):
+        if self.writer is None:
+            self.open(df)
+        for column, categories in self.categories.items():
+            values = df[column].cat.categories
+            categories.extend(values[~values.isin(categories)])
+            df = df.assign(**{column: df[column].cat.set_categories(categories)})
+        self.writer.write_table(pa.Table.from_pandas(df, preserve_index=False).cast(self.schema))
+
+    def commit(self):
+        # Make the rows written so far the output; the next write copies them into a new temporary file
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.output_file_name + '.tmp', self.output_file_name)
+            self.writer, self.append = None, True
+
+
+def write_output(job_type_waiting_df, output_file_name, append=False, part_name='part', feather_output=None):
+    """
+    Save the results to a CSV file, to a typed Feather file when
+    output_file_name ends with .feather, or to a Parquet dataset (write_dataset)
+    when it has neither extension. Feather files cannot be appended to in
+    place: rows go to feather_output, the run's FeatherOutput, and only reach
+    the file when it is committed. Without one, the file is rewritten
+    (atomically) with the new rows added.
+    """
+    if is_dataset(output_file_name):
+        write_dataset(job_type_waiting_df, output_file_name, part_name)
+    elif output_file_name.endswith('.feather'):
+        output = feather_output or FeatherOutput(output_file_name, append)
+        output.write(job_type_waiting_df)
+        if feather_output is None:
+            output.commit()
+    elif append:
+        job_type_waiting_df.to_csv(output_file_name, mode='a', header=False, index=False, chunksize=100000)
+    else:
+        job_type_waiting_df.to_csv(output_file_name, index=False, chunksize=100000)
+
+
+def resume_output(output_file_name, saved_size, year, watermark):
+    """
+    Get an output ready to resume from a state saved when it was saved_size
+    bytes long, by dropping whatever was written after the state was saved
+    (e.g. by a run killed before it finished). Returns False, saying why,
+    when the output cannot be resumed and the whole year is recomputed.
+    """
+    if saved_size is None or not os.path.exists(output_file_name):
+        print(f'{output_file_name} was not written by the run that saved the state, recomputing the whole year')
+        return False
+    outdated = outdated_columns(output_file_name, year)
+    if outdated:
+        print(f'{output_file_name} still has {", ".join(outdated)} from an older version, recomputing the whole year')
+        return False
+    if is_dataset(output_file_name):
+        # Parts are named after the watermark their run started from, so these are from a run killed before
+        # it saved its state
+        remove_parts(output_file_name, year, f'part-{watermark}-')
+        return True
+    if os.path.getsize(output_file_name) < saved_size or \
+            (output_file_name.endswith('.feather') and os.path.getsize(output_file_name) != saved_size):
+        print(f'{output_file_name} does not match the saved state, recomputing the whole year')
+        return False
+    os.truncate(output_file_name, saved_size)
+    return True
+
+
+def waiting_time_per_job_type(input_file_name, output_file_name, year, state_file_name=None, batch_rows=None,
+                              checkpoint_seconds=None, metrics=None, shards=None, workers=None, backend='pandas',
+                              extra_outputs=None, collapse_arrays=False, previous_input_file_name=None):
+    """
+    Compute first job waiting times for one year of accounting records.
+
+    With state_file_name, the run is incremental: if a state from an earlier
+    run exists, only records that ended after its watermark are read and the
+    new rows are appended to output_file_name. The state is updated at the end.
+
+    Jobs that ran over new year's are in the file of the year they ended in,
+    so that file alone has every end time the year's first jobs depend on.
+    Its jobs submitted in an earlier year are first jobs of that year: they
+    are written to earlier_years_file(output_file_name, year), with their
+    own year, which the consolidation adds to that year. Their flags depend
+    on the jobs of the year before, so a run that does not resume a state
+    starts from the end times of previous_input_file_name, the accounting
+    file of the year before (previous_year_end_times), if there is one.
+
+    output_file_name can be a CSV file, a Feather file or a Parquet dataset
+    directory (see write_output); a dataset keeps every year under year=.
+
+    With batch_rows, records are streamed in batches of about that many rows
+    (see helpers.stream_accounting) and latest_end_times is carried from one
+    batch to the next, so peak memory no longer grows with the year.
+    checkpoint_seconds then saves the state at most that
+    often, after the batch that was being processed. A run that is killed,
+    e.g. at the SGE wall-clock limit, resumes from its last checkpoint when it
+    is started again with the same state_file_name.
+
+    With shards, every batch is split into that many owner shards that are
+    scanned by a pool of worker processes (see select_first_jobs_sharded).
+    The output is the same as without shards.
+
+    backend picks the DataFrame library of the first-job scan (see BACKENDS);
+    the output is the same with every backend. Shards always use pandas.
+
+    extra_outputs ({name: file name}, names from EXTRA_OUTPUT_TEMPLATES) adds
+    outputs of the same scan. all_jobs gets the waiting times of every job,
+    written, resumed and checkpointed along with output_file_name.
+    owner_counts is added up batch by batch and carried from run to run next
+    to the state (owner_counts_state_file); queue_percentiles is rebuilt
+    from the year's all_jobs rows at the end of the run (write_summaries).
+    These only have the jobs submitted in year.
+
+    collapse_arrays replaces the tasks of every array job by one record
+    (helpers.collapse_array_tasks) before the first-job scan, so each array
+    job is a single job with tasks and last_task_waiting_time columns. The
+    tasks of an array can end in different batches or runs, so arrays are
+    only collapsed over the whole year at once: not with state_file_name or
+    batch_rows.
+    """
+    if shards and backend != 'pandas':
+        raise ValueError('owner shards are scanned with the pandas backend only')
+    if checkpoint_seconds and not (state_file_name and batch_rows):
+        raise ValueError('checkpoints need a state file and batch_rows')
+    if collapse_arrays and (state_file_name or batch_rows):
+        raise ValueError('array jobs are collapsed over the whole year, without a state file or batch_rows')
+    extra_outputs = extra_outputs or {}
+    all_jobs_file_name = extra_outputs.get('all_jobs')
+    if set(extra_outputs) - set(EXTRA_OUTPUT_TEMPLATES):
+        raise ValueError(f'unknown outputs {sorted(set(extra_outputs) - set(EXTRA_OUTPUT_TEMPLATES))}')
+    if extra_outputs and not all_jobs_file_name:
+        raise ValueError('the summaries are computed from the all_jobs output, which is missing')
+    if extra_outputs and shards:
+        raise ValueError('owner shards only write the first-job output')
+    earlier_years_file_name = earlier_years_file(output_file_name, year)
+    output_file_names = [output_file_name, earlier_years_file_name]
+    if all_jobs_file_name:
+        output_file_names.append(all_jobs_file_name)
+    metrics = metrics or StageMetrics()
+    latest_end_times, watermark, append = None, None, False
+    if state_file_name and os.path.exists(state_file_name) and os.path.exists(output_file_name):
+        latest_end_times, watermark, saved_size = load_state(state_file_name)
+        saved_sizes = [saved_size, load_output_size(state_file_name, 'earlier_years')] + \
+            ([load_output_size(state_file_name, 'all_jobs')] if all_jobs_file_name else [])
+        if all(resume_output(name, size, year, watermark) for name, size in zip(output_file_names, saved_sizes)):
+            append = True
+            print(f'Resuming from watermark {watermark} with {len(latest_end_times)} (owner, job_type) states')
+        else:
+            latest_end_times, watermark = None, None
+    if not append and previous_input_file_name:
+        if os.path.exists(previous_input_file_name):
+            with metrics.stage('previous_year') as stage:
+                latest_end_times = previous_year_end_times(previous_input_file_name, batch_rows)
+                stage['rows_out'] = len(latest_end_times)
+        else:
+            print(f'{previous_input_file_name} not found: the jobs submitted before {year} are scanned without '
+                  'the end times of the year before')
+    owner_counts = None
+    if 'owner_counts' in extra_outputs and append:
+        owner_counts = load_owner_counts(state_file_name, watermark)
+        if owner_counts is None:
+            print(f'No owner counts saved with {state_file_name}, counting the jobs already in {all_jobs_file_name}')
+            owner_counts = owner_job_counts(read_waiting_times(all_jobs_file_name, year, dtypes=ALL_JOB_DTYPES))
+    for name in output_file_names:
+        if not append and is_dataset(name):
+            remove_parts(name, year)
+    os.makedirs(os.path.dirname(earlier_years_file_name) or '.', exist_ok=True)
+    # Feather outputs are committed with the state, so their size always matches the saved one
+    feather_outputs = {name: FeatherOutput(name, append) for name in output_file_names if name.endswith('.feather')}
+
+    # Read the cols we need from the Feather file, removing records where 'mpi' exists in granted_pe
+    # and its pe_taskid column has a valid value (MPI subtasks) while scanning
+    batches = read_batches(input_file_name, batch_rows, min_end_time=watermark,
+                           as_table=bool(shards) or backend != 'pandas' or collapse_arrays)
+
+    part_watermark = watermark or 0
+    last_checkpoint = time.time()
+    total_first_jobs, total_earlier_first_jobs = 0, 0
+    executor = ProcessPoolExecutor(max_workers=workers or min(shards, default_workers())) if shards else None
+    try:
+        for batch_number, df in enumerate(timed_batches(batches, metrics)):
+            if len(df):
+                watermark = max(int(np.asarray(df['ux_end_time']).max()), watermark or 0)
+            if collapse_arrays:
+                with metrics.stage('collapse_arrays', rows_in=len(df)) as stage:
+                    df = collapse_array_tasks(df)
+                    if backend == 'pandas' and not shards:
+                        df = df.to_pandas(split_blocks=True, self_destruct=True)
+                    stage['rows_out'] = len(df)
+            if executor:
+                with metrics.stage('sharded_scan', rows_in=len(df)) as stage:
+                    rows, latest_end_times = select_first_jobs_sharded(df, latest_end_times, executor, shards, metrics)
+                    stage['rows_out'] = len(rows)
+            else:
+                first_jobs, latest_end_times = BACKENDS[backend](df, latest_end_times, metrics=metrics,
+                                                                 verbose=not batch_rows,
+                                                                 all_jobs=bool(all_jobs_file_name))
+                if all_jobs_file_name:
+                    jobs = first_jobs[first_jobs['year'].to_numpy() == year]
+                    first_jobs = first_jobs[first_jobs['first_job'].to_numpy()]
+                rows = waiting_time_rows(first_jobs)
+            earlier_rows, rows = split_earlier_years(rows, year)
+            with metrics.stage('write', rows_in=len(rows) + len(earlier_rows)) as stage:
+                write_output(rows, output_file_name, append, part_name=f'part-{part_watermark}-{batch_number}',
+                             feather_output=feather_outputs.get(output_file_name))
+                write_output(earlier_rows, earlier_years_file_name, append,
+                             feather_output=feather_outputs.get(earlier_years_file_name))
+                if all_jobs_file_name:
+                    job_rows = all_job_rows(jobs)
+                    write_output(job_rows, all_jobs_file_name, append,
+                                 part_name=f'part-{part_watermark}-{batch_number}',
+                                 feather_output=feather_outputs.get(all_jobs_file_name))
+                stage['rows_out'] = len(rows)
+            if 'owner_counts' in extra_outputs:
+                with metrics.stage('owner_counts', rows_in=len(job_rows)) as stage:
+                    owner_counts = merge_owner_counts(owner_counts, owner_job_counts(job_rows))
+                    stage['rows_out'] = len(owner_counts)
+            append = True
+            total_first_jobs += len(rows)
+            total_earlier_first_jobs += len(earlier_rows)
+            if batch_rows:
+                print(f'Processed a batch of {len(df)} jobs up to ux_end_time {watermark}: {len(rows)} first jobs')
+
+            if checkpoint_seconds and time.time() - last_checkpoint >= checkpoint_seconds:
+                for output in feather_outputs.values():
+                    output.commit()
+                save_state(state_file_name, latest_end_times, watermark or 0, output_size(output_file_name),
+                           output_size(all_jobs_file_name) if all_jobs_file_name else None, owner_counts,
+                           output_size(earlier_years_file_name))
+                part_watermark = watermark or 0  # parts written after this checkpoint are removed on resume
+                last_checkpoint = time.time()
+                print(f'Checkpoint saved at ux_end_time {watermark} ({total_first_jobs} first jobs so far)')
+    finally:
+        # Also when a batch fails, so the workers do not outlive the run
+        if executor:
+            executor.shutdown()
+    for output in feather_outputs.values():
+        output.commit()
+    if state_file_name:
+        save_state(state_file_name, latest_end_times, watermark or 0, output_size(output_file_name),
+                   output_size(all_jobs_file_name) if all_jobs_file_name else None, owner_counts,
+                   output_size(earlier_years_file_name))
+    print(f'Added {total_first_jobs} first jobs, and {total_earlier_first_jobs} of earlier years to '
+          f'{earlier_years_file_name}')
+    if 'owner_counts' in extra_outputs:
+        write_summary(owner_counts, extra_outputs['owner_counts'])
+    if 'queue_percentiles' in extra_outputs:
+        write_summaries(all_jobs_file_name, extra_outputs, year, metrics)
+    metrics.write()
+
 
 # Example usage
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process accounting data.')
     parser.add_argument('year', type=int, help='Year of the data to process')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only process records newer than the saved state and append them to the output')
+    parser.add_argument('--batch-rows', type=int, default=None,
+                        help='Stream the accounting file in batches of about this many rows to bound memory use')
+    parser.add_argument('--checkpoint-minutes', type=float, default=None,
+                        help='With --batch-rows, save the state this often; rerun the same command to resume')
+    parser.add_argument('--metrics', default=None,
+                        help='Append per-stage timings, row counts and peak memory to this JSON-lines file')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='Split every batch into this many owner shards and scan them in parallel')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes for --shards (default: NSLOTS or the number of cores)')
+    parser.add_argument('--dataset', action='store_true',
+                        help=f'Write to the partitioned Parquet dataset {DATASET_DIR} instead of the yearly CSV')
+    parser.add_argument('--backend', choices=list(BACKENDS), default='pandas',
+                        help='DataFrame library of the first-job scan; polars uses all the cores')
+    parser.add_argument('--extra-outputs', nargs='+', choices=list(EXTRA_OUTPUT_TEMPLATES), default=[],
+                        help='Also write these outputs from the same scan (the summaries imply all_jobs)')
+    parser.add_argument('--collapse-arrays', action='store_true',
+                        help='Count every array job once, with its number of tasks and the wait of its last task')
     args = parser.parse_args()
+    if args.shards and args.backend != 'pandas':
+        parser.error('--shards uses the pandas backend')
+    if args.checkpoint_minutes and not args.batch_rows:
+        parser.error('--checkpoint-minutes requires --batch-rows')
+    if args.shards and args.extra_outputs:
+        parser.error('--shards only writes the first-job output')
+    if args.collapse_arrays and (args.incremental or args.batch_rows):
+        parser.error('--collapse-arrays processes the whole year at once, without --incremental or --batch-rows')
 
     year = args.year
-    input_file_name = f'/projectnb/rcsmetrics/accounting/data/scc/{year}.feather'
-    output_file_name = f'/projectnb/rcs-intern/Jiazheng/accounting/waiting_times_{year}_per_job_type.csv'
+    input_file_name = INPUT_FILE_TEMPLATE.format(year=year)
+    output_file_name = DATASET_DIR if args.dataset else OUTPUT_FILE_TEMPLATE.format(year=year)
+    state_file_name = STATE_FILE_TEMPLATE.format(year=year) if args.incremental or args.checkpoint_minutes else None
+    extra_outputs = extra_output_files(args.extra_outputs, year)
+    if args.dataset and extra_outputs:
+        extra_outputs['all_jobs'] = ALL_JOBS_DATASET_DIR
 
+    metrics = StageMetrics(args.metrics, script='GetQueueTime', year=year, batch_rows=args.batch_rows,
+                           shards=args.shards, backend=args.backend, collapse_arrays=args.collapse_arrays)
     start_time = time.time()
-    waiting_time_per_job_type(input_file_name, output_file_name, year)
+    waiting_time_per_job_type(input_file_name, output_file_name, year, state_file_name, batch_rows=args.batch_rows,
+                              checkpoint_seconds=args.checkpoint_minutes * 60 if args.checkpoint_minutes else None,
+                              metrics=metrics, shards=args.shards, workers=args.workers,
+                              backend=args.backend, extra_outputs=extra_outputs, collapse_arrays=args.collapse_arrays,
+                              previous_input_file_name=INPUT_FILE_TEMPLATE.format(year=year - 1))
     end_time = time.time()
 
     running_time = end_time - start_time
 
     print(f"First job waiting times per job type saved to {output_file_name}")
+    for name, file_name in extra_outputs.items():
+        print(f"{name} saved to {file_name}")
+    metrics.report()
     print(f"Running time: {running_time} seconds")
-
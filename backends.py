@@ -0,0 +1,193 @@
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+from metrics import StageMetrics
+from helpers import JOB_TYPES, MPI_PE_PATTERN, MONTHS, queue_catalog, local_seconds, merge_latest_end_times
+
+# The Arrow and Polars versions of GetQueueTime.select_first_jobs_pandas (prepare_jobs + select_first_jobs).
+# Each one takes an Arrow table of accounting records and returns the same first jobs, as a DataFrame with the
+# same columns, dtypes, order and index (the row number in the table), and the same updated latest_end_times.
+# With all_jobs, every job with a valid waiting time is returned, with a first_job column. As in prepare_jobs, every
+# job gets the year it was submitted in, which for the jobs of a yearly file that were submitted before the year is
+# not the year of the file.
+
+FIRST_JOB_COLUMNS = ['ux_submission_time', 'ux_start_time', 'ux_end_time', 'options', 'qname', 'job_number',
+                     'owner', 'slots']
+ARRAY_COLUMNS = ['tasks', 'ux_last_start_time']  # added by helpers.collapse_array_tasks
+
+
+def previous_group_max(groups, values):
+    """
+    For every row, the max of values over the earlier rows of its group (0 for
+    the first row of a group), and the max of every group. This is the grouped
+    cummax shifted by one row: the groups are laid out one after the other by
+    a stable sort and offset so that a single running max never crosses from
+    one group into the next.
+    """
+    if not len(groups):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    order = np.argsort(groups, kind='stable')
+    sorted_groups = groups[order].astype(np.int64)
+    low = int(values.min())
+    span = int(values.max()) - low + 1
+    running = np.maximum.accumulate(sorted_groups * span + (values[order] - low)) - sorted_groups * span + low
+    first = np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]
+    last = np.r_[sorted_groups[1:] != sorted_groups[:-1], True]
+    previous = np.empty_like(running)
+    previous[1:] = running[:-1]
+    previous[first] = 0
+    result = np.empty_like(previous)
+    result[order] = previous
+    group_max = np.zeros(int(sorted_groups[-1]) + 1, dtype=np.int64)
+    group_max[sorted_groups[last]] = running[last]
+    return result, group_max
+
+
+def carried_end_times(owners, job_type_codes, latest_end_times):
+    # Latest end time carried in latest_end_times for each (owner, job type code) pair, 0 if none
+    if latest_end_times is None or not len(latest_end_times):
+        return np.zeros(len(owners), dtype=np.int64)
+    keys = pd.DataFrame({'owner': owners, 'job_type': np.asarray(JOB_TYPES, dtype=object)[job_type_codes]})
+    return (keys.merge(latest_end_times, on=['owner', 'job_type'], how='left')['latest_end_time']
+            .fillna(0).to_numpy(dtype=np.int64))
+
+
+def first_jobs_frame(columns, job_type_codes, qname_codes, qnames, catalog_rows, local, index, first_job=None):
+    # The first jobs as the pandas pipeline has them after prepare_jobs, with its categoricals
+    catalog = queue_catalog()
+    local = pd.DatetimeIndex(pd.to_datetime(local, unit='s'))
+    df = pd.DataFrame(columns, index=pd.Index(index))
+    df['job_type'] = pd.Categorical.from_codes(job_type_codes, categories=JOB_TYPES)
+    df['qname'] = pd.Categorical.from_codes(qname_codes, qnames)
+    for column in ['class_user', 'class_own']:
+        classes = catalog[column].array
+        df[column] = pd.Categorical.from_codes(np.where(catalog_rows >= 0, classes.codes[catalog_rows], -1),
+                                               dtype=classes.dtype)
+    df['year'] = local.year
+    df['month'] = pd.Categorical.from_codes(local.month - 1, categories=MONTHS, ordered=True)
+    df['day'] = local.day
+    if first_job is not None:
+        df['first_job'] = first_job
+    return df
+
+
+def select_first_jobs_arrow(table, latest_end_times=None, metrics=None, verbose=False, all_jobs=False):
+    """
+    prepare_jobs + select_first_jobs with pyarrow.compute kernels, and numpy
+    on the zero-copy column buffers for the grouped running max.
+    """
+    metrics = metrics or StageMetrics()
+    table = table.combine_chunks()
+    with metrics.stage('classify', rows_in=table.num_rows) as stage:
+        # Same precedence as helpers.determine_job_type: GPU, then 1-p, then MPI, otherwise OMP
+        job_type_codes = np.full(table.num_rows, JOB_TYPES.index('OMP'), dtype=np.int8)
+        for job_type, matches in [
+                ('MPI', pc.match_substring_regex(table['granted_pe'], MPI_PE_PATTERN)),
+                ('1-p', pc.equal(table['slots'], 1)),
+                ('GPU', pc.match_substring(table['options'], 'gpus='))]:
+            job_type_codes[pc.fill_null(matches, False).to_numpy(zero_copy_only=False)] = JOB_TYPES.index(job_type)
+        stage['rows_out'] = table.num_rows
+    with metrics.stage('queue_mapping', rows_in=table.num_rows) as stage:
+        # Look up each distinct qname once, like helpers.check_shared_buyin
+        qname_dictionary = pc.dictionary_encode(table['qname']).combine_chunks()
+        qnames = qname_dictionary.dictionary.to_pandas()
+        qname_codes = pc.fill_null(qname_dictionary.indices, -1).to_numpy().astype(np.int64)
+        catalog_rows = np.append(queue_catalog().index.get_indexer(qnames), -1)[qname_codes]
+        stage['rows_out'] = table.num_rows
+    with metrics.stage('sort', rows_in=table.num_rows) as stage:
+        order = pc.sort_indices(table['ux_end_time']).to_numpy()  # Arrow's sort is stable, like kind='stable'
+        stage['rows_out'] = len(order)
+    with metrics.stage('calendar', rows_in=len(order)) as stage:
+        local = local_seconds(table['ux_submission_time'].to_numpy()[order])
+        stage['rows_out'] = len(local)
+    with metrics.stage('first_job_scan', rows_in=len(order)) as stage:
+        owner_dictionary = pc.dictionary_encode(table['owner'].take(order), null_encoding='encode').combine_chunks()
+        owner_codes = owner_dictionary.indices.to_numpy().astype(np.int64)
+        groups, pairs = pd.factorize(owner_codes * len(JOB_TYPES) + job_type_codes[order])
+        end_time = table['ux_end_time'].to_numpy()[order].astype(np.int64)
+        previous, group_max = previous_group_max(groups, end_time)
+        owners = owner_dictionary.dictionary.to_numpy(zero_copy_only=False)[pairs // len(JOB_TYPES)]
+        carried = carried_end_times(owners, pairs % len(JOB_TYPES), latest_end_times)
+        submission = table['ux_submission_time'].to_numpy()[order]
+        start = table['ux_start_time'].to_numpy()[order]
+        first_job, output = submission > np.maximum(previous, carried[groups]), start >= submission
+        selected = output if all_jobs else first_job & output
+        keys = pd.DataFrame({'owner': owners, 'job_type': np.asarray(JOB_TYPES, dtype=object)[pairs % len(JOB_TYPES)],
+                             'latest_end_time': np.maximum(carried, group_max)})
+        latest_end_times = merge_latest_end_times(latest_end_times, keys)
+
+        rows = order[selected]
+        columns = {name: table[name].take(rows).to_numpy(zero_copy_only=False)
+                   for name in FIRST_JOB_COLUMNS + ARRAY_COLUMNS if name in table.column_names}
+        first_jobs = first_jobs_frame(columns, job_type_codes[rows], qname_codes[rows], qnames, catalog_rows[rows],
+                                      local[selected], rows, first_job[selected] if all_jobs else None)
+        stage['rows_out'] = len(first_jobs)
+    return first_jobs, latest_end_times
+
+
+def select_first_jobs_polars(table, latest_end_times=None, metrics=None, verbose=False, all_jobs=False):
+    """
+    prepare_jobs + select_first_jobs as one lazy Polars query, which runs on
+    all the cores. The first jobs and the new latest end times are collected
+    together, so Polars plans and runs the whole scan at once; StageMetrics
+    therefore times it as a single polars_query stage.
+    """
+    try:
+        import polars as pl
+    except ImportError:
+        raise ImportError('the polars backend needs the polars package (pip install polars)') from None
+    metrics = metrics or StageMetrics()
+    with metrics.stage('polars_query', rows_in=table.num_rows) as stage:
+        jobs = pl.from_arrow(table).lazy().with_row_index('row')
+        # qname codes in order of first appearance, as pd.factorize numbers them in check_shared_buyin
+        qnames = pc.unique(table['qname']).drop_null()
+        codes = pl.DataFrame({'qname': pl.from_arrow(qnames).cast(jobs.collect_schema()['qname']),
+                              'qname_code': np.arange(len(qnames)),
+                              'catalog_row': queue_catalog().index.get_indexer(qnames.to_pandas())}).lazy()
+        state = pl.LazyFrame({'owner': [], 'job_code': [], 'carried': []},
+                             schema={'owner': pl.String, 'job_code': pl.Int8, 'carried': pl.Int64})
+        if latest_end_times is not None and len(latest_end_times):
+            state = pl.LazyFrame({
+                'owner': latest_end_times['owner'].astype(str).to_numpy(),
+                'job_code': pd.Categorical(latest_end_times['job_type'], categories=JOB_TYPES).codes.astype(np.int8),
+                'carried': latest_end_times['latest_end_time'].to_numpy(dtype=np.int64),
+            }).filter(pl.col('job_code') >= 0)
+
+        jobs = (jobs.with_columns(
+                    job_code=pl.when(pl.col('options').str.contains('gpus=', literal=True).fill_null(False))
+                    .then(JOB_TYPES.index('GPU'))
+                    .when((pl.col('slots') == 1).fill_null(False)).then(JOB_TYPES.index('1-p'))
+                    .when(pl.col('granted_pe').str.contains(MPI_PE_PATTERN).fill_null(False))
+                    .then(JOB_TYPES.index('MPI'))
+                    .otherwise(JOB_TYPES.index('OMP')).cast(pl.Int8),
+                    local=pl.col('ux_submission_time').map_batches(
+                        lambda submission: pl.Series(local_seconds(submission.to_numpy())), return_dtype=pl.Int64),
+                    ux_end_time=pl.col('ux_end_time').cast(pl.Int64), owner=pl.col('owner').cast(pl.String))
+                .join(codes, on='qname', how='left')
+                .join(state, on=['owner', 'job_code'], how='left')
+                .sort(['ux_end_time', 'row'])  # scan order, whatever order the joins left the rows in
+                .with_columns(pl.col('qname_code').fill_null(-1), pl.col('catalog_row').fill_null(-1),
+                              pl.col('carried').fill_null(0),
+                              previous=pl.col('ux_end_time').cum_max().shift(1, fill_value=0)
+                              .over(['owner', 'job_code'])))
+        keys = (jobs.group_by(['owner', 'job_code'], maintain_order=True)
+                .agg(pl.col('ux_end_time').max(), pl.col('carried').first())
+                .select('owner', 'job_code', latest_end_time=pl.max_horizontal('ux_end_time', 'carried')))
+        first = (jobs.with_columns(first_job=pl.col('ux_submission_time') > pl.max_horizontal('previous', 'carried'))
+                 .filter((pl.col('ux_start_time') >= pl.col('ux_submission_time'))
+                         & (pl.lit(all_jobs) | pl.col('first_job'))))
+        first, keys = pl.collect_all([first, keys])
+
+        keys = pd.DataFrame({
+            'owner': keys['owner'].to_numpy().astype(object),
+            'job_type': np.asarray(JOB_TYPES, dtype=object)[keys['job_code'].to_numpy()],
+            'latest_end_time': keys['latest_end_time'].to_numpy(),
+        })
+        latest_end_times = merge_latest_end_times(latest_end_times, keys)
+        columns = {name: first[name].to_numpy() for name in FIRST_JOB_COLUMNS + ARRAY_COLUMNS if name in first.columns}
+        first_jobs = first_jobs_frame(columns, first['job_code'].to_numpy(), first['qname_code'].to_numpy(),
+                                      qnames.to_pandas(), first['catalog_row'].to_numpy(), first['local'].to_numpy(),
+                                      first['row'].to_numpy().astype(np.int64),
+                                      first['first_job'].to_numpy() if all_jobs else None)
+        stage['rows_out'] = len(first_jobs)
+    return first_jobs, latest_end_times
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# Benchmark helpers.determine_job_type against the old row-wise df.apply classifier
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from helpers import determine_job_type
+
+
+def get_job_type(row):
+    # The per-row rules determine_job_type used before it was vectorized
+    if row['options'] and 'gpus=' in row['options']:
+        return 'GPU'
+    elif row['slots'] == 1:
+        return '1-p'
+    elif row['granted_pe'] is not None and any(keyword in row['granted_pe'] for keyword in ['tasks_per_node', 'mpi_', 'mpi128']):
+        return 'MPI'
+    else:
+        return 'OMP'
+
+
+def make_jobs(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    options = np.array(['', 'gpus=1', 'gpus=2,gpu_c=7.0', 'h_rt=12:00:00', None], dtype=object)
+    granted_pe = np.array([None, 'omp', 'omp16', 'mpi_16_tasks_per_node', 'mpi_28_tasks_per_node', 'mpi128'], dtype=object)
+    return pd.DataFrame({
+        'options': options[rng.choice(len(options), n_rows, p=[0.45, 0.08, 0.02, 0.25, 0.2])],
+        'slots': rng.choice([1, 1, 1, 2, 4, 8, 16, 28, 32], n_rows),
+        'granted_pe': granted_pe[rng.choice(len(granted_pe), n_rows)],
+    })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark job type classification.')
+    parser.add_argument('--rows', type=int, default=2_000_000, help='Number of synthetic jobs')
+    parser.add_argument('--rowwise-rows', type=int, default=200_000,
+                        help='Rows timed with the row-wise classifier (it is extrapolated to --rows)')
+    args = parser.parse_args()
+
+    df = make_jobs(args.rows)
+
+    start_time = time.time()
+    vectorized = determine_job_type(df.copy())['job_type']
+    vectorized_time = time.time() - start_time
+
+    sample = df.iloc[:args.rowwise_rows]
+    start_time = time.time()
+    rowwise = sample.apply(get_job_type, axis=1)
+    rowwise_time = (time.time() - start_time) * len(df) / len(sample)
+
+    assert (vectorized.iloc[:len(sample)].astype(object) == rowwise).all(), 'classifiers disagree'
+    print(f"Rows: {len(df)}")
+    print(f"Row-wise apply: {rowwise_time:.2f} seconds (extrapolated from {len(sample)} rows)")
+    print(f"Vectorized:     {vectorized_time:.2f} seconds")
+    print(f"Speedup:        {rowwise_time / vectorized_time:.1f}x")
+    print(f"Memory: {rowwise.memory_usage(deep=True) * len(df) / len(sample) / 2**20:.1f} MiB object vs "
+          f"{vectorized.memory_usage(deep=True) / 2**20:.1f} MiB categorical")
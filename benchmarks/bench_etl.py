@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# Benchmark the waiting time ETL on synthetic accounting files of 1M, 10M and 50M records
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import pyarrow.feather as feather
+from metrics import StageMetrics
+from helpers import read_accounting, determine_job_type, check_shared_buyin, _queue_catalogs
+from GetQueueTime import waiting_time_per_job_type
+from synthetic_accounting import write_synthetic_accounting, synthetic_work_dir
+
+DEFAULT_SIZES = ['1M', '10M', '50M']
+YEAR = 2024
+
+
+def parse_size(size):
+    # '10M' -> 10_000_000, '500k' -> 500_000
+    multipliers = {'k': 1_000, 'm': 1_000_000}
+    if size[-1].lower() in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1].lower()])
+    return int(size)
+
+
+def accounting_file(data_dir, size, seed):
+    # Generate each size once and reuse it, generation of the 50M file takes a few minutes
+    input_file_name = os.path.join(data_dir, f'accounting_{size}_{seed}.feather')
+    if not os.path.exists(input_file_name):
+        print(f'Generating {parse_size(size)} synthetic records in {input_file_name}')
+        write_synthetic_accounting(input_file_name, parse_size(size), YEAR, seed)
+    return input_file_name
+
+
+def timed(function, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+
+def bench_size(input_file_name, output_dir, batch_rows, metrics_file_name, size):
+    n_rows = feather.read_table(input_file_name, columns=[], memory_map=True).num_rows
+    results = []
+
+    # Classification and queue mapping on the columns they read, as prepare_jobs sees them
+    df = read_accounting(input_file_name, columns=['options', 'slots', 'granted_pe'])
+    _, seconds = timed(determine_job_type, df)
+    results.append({'function': 'determine_job_type', 'rows': len(df), 'seconds': seconds})
+    del df
+
+    df = read_accounting(input_file_name, columns=['qname'])
+    _queue_catalogs.clear()
+    _, seconds = timed(check_shared_buyin, df)
+    results.append({'function': 'check_shared_buyin', 'rows': len(df), 'seconds': seconds})
+    _, seconds = timed(check_shared_buyin, df)
+    results.append({'function': 'check_shared_buyin (cached catalog)', 'rows': len(df), 'seconds': seconds})
+    del df
+
+    output_file_name = os.path.join(output_dir, f'waiting_times_{size}.feather')
+    metrics = StageMetrics(metrics_file_name, script='bench_etl', size=size, rows=n_rows, batch_rows=batch_rows)
+    _, seconds = timed(waiting_time_per_job_type, input_file_name, output_file_name, YEAR,
+                       batch_rows=batch_rows, metrics=metrics)
+    results.append({'function': 'waiting_time_per_job_type', 'rows': n_rows, 'seconds': seconds})
+    os.remove(output_file_name)
+    return results, metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the waiting time ETL on synthetic accounting data.')
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES,
+                        help='Numbers of records to benchmark, e.g. 1M 10M 50M')
+    parser.add_argument('--data-dir', default=os.path.join(BENCH_DIR, 'data'),
+                        help='Where the synthetic accounting files are generated and kept')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic data')
+    parser.add_argument('--batch-rows', type=int, default=None,
+                        help='Stream waiting_time_per_job_type in batches of this many rows (recommended for 50M)')
+    parser.add_argument('--metrics', default=None,
+                        help='Append per-stage metrics of every ETL run to this JSON-lines file')
+    parser.add_argument('--results', default=None, help='Append the timings to this JSON-lines file')
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    all_results = []
+    with synthetic_work_dir(args.data_dir, args.seed), tempfile.TemporaryDirectory() as output_dir:
+        for size in args.sizes:
+            input_file_name = accounting_file(args.data_dir, size, args.seed)
+            results, metrics = bench_size(input_file_name, output_dir, args.batch_rows, args.metrics, size)
+            metrics.report()
+            for result in results:
+                result.update(size=size, batch_rows=args.batch_rows, rows_per_second=result['rows'] / result['seconds'])
+            all_results.extend(results)
+
+    print(f"{'Size':<6} {'Function':<36} {'Rows':>12} {'Seconds':>10} {'Rows/s':>14}")
+    for result in all_results:
+        print(f"{result['size']:<6} {result['function']:<36} {result['rows']:>12} {result['seconds']:>10.2f} "
+              f"{result['rows_per_second']:>14,.0f}")
+    if args.results:
+        with open(args.results, 'a') as results_file:
+            for result in all_results:
+                results_file.write(json.dumps(result) + '\n')
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Check that every GetQueueTime backend writes the same output and state, and time them
+import os
+import sys
+import time
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import pandas as pd
+from helpers import read_waiting_times, earlier_years_file
+from GetQueueTime import waiting_time_per_job_type, load_state
+from synthetic_accounting import write_synthetic_accounting, synthetic_work_dir
+
+YEAR = 2024
+
+
+def run_backend(backend, input_file_name, output_dir, batch_rows):
+    # One GetQueueTime run; returns its output, earlier-years output, sorted state and running time
+    mode = f'{backend}_{batch_rows or "full"}'
+    output_file_name = os.path.join(output_dir, f'{mode}.feather')
+    state_file_name = os.path.join(output_dir, f'{mode}_state.feather')
+    start_time = time.perf_counter()
+    waiting_time_per_job_type(input_file_name, output_file_name, YEAR, state_file_name, batch_rows=batch_rows,
+                              backend=backend)
+    seconds = time.perf_counter() - start_time
+    state = load_state(state_file_name)[0].astype(str).sort_values(['owner', 'job_type'], ignore_index=True)
+    return (read_waiting_times(output_file_name), read_waiting_times(earlier_years_file(output_file_name, YEAR)),
+            state, seconds)
+
+
+def differences(expected, actual):
+    # Names of the frames of two runs that differ; categoricals are compared by value, not by category order
+    names = []
+    for name, a, b in zip(['output', 'earlier_years', 'state'], expected, actual):
+        try:
+            pd.testing.assert_frame_equal(a, b, check_categorical=False)
+        except AssertionError as error:
+            print(f'  {name}: {str(error).splitlines()[0]}')
+            names.append(name)
+    return names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check that the pandas, arrow and polars backends agree.')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='Synthetic accounting records per year')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic data')
+    parser.add_argument('--batch-rows', type=int, default=200_000, help='Batch size of the streaming runs')
+    parser.add_argument('--backends', nargs='+', default=['pandas', 'arrow', 'polars'],
+                        help='Backends to check; the first one is the reference')
+    args = parser.parse_args()
+
+    with synthetic_work_dir(seed=args.seed) as work_dir:
+        # The file starts with jobs submitted the year before, which go to the earlier-years output; the streaming
+        # runs check the state carried from batch to batch
+        input_file_name = os.path.join(work_dir, f'{YEAR}.feather')
+        write_synthetic_accounting(input_file_name, args.rows, YEAR, args.seed)
+
+        failures = []
+        print(f"{'Backend':<8} {'Batches':<8} {'Rows':>10} {'Seconds':>9}  Differences")
+        for batch_rows in [None, args.batch_rows]:
+            reference = None
+            for backend in args.backends:
+                *frames, seconds = run_backend(backend, input_file_name, work_dir, batch_rows)
+                if reference is None:
+                    reference, different = frames, []
+                else:
+                    different = differences(reference, frames)
+                print(f"{backend:<8} {batch_rows or 'full':<8} {len(frames[0]):>10} {seconds:>9.2f}  "
+                      f"{', '.join(different) or '-'}")
+                failures.extend((backend, batch_rows, name) for name in different)
+
+    if failures:
+        sys.exit(f'{len(failures)} mismatches: {failures}')
+    print('All backends agree')
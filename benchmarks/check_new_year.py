@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Check that a job running over new year's still hides the next job of its owner, and that the first jobs submitted
+# the year before go to the earlier-years output with their own year, with every backend and mode
+import os
+import sys
+import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import pyarrow as pa
+from pyarrow import feather
+from helpers import read_waiting_times, earlier_years_file
+from GetQueueTime import waiting_time_per_job_type
+from synthetic_accounting import ACCOUNTING_SCHEMA, queue_info, synthetic_work_dir
+
+YEAR = 2024
+
+# (owner, job_number, submitted, started, ended) in local time; every year's file has the jobs that ended in it
+JOBS = [
+    ('alice', 1, '2023-12-29 08:00', '2023-12-29 08:05', '2023-12-31 23:30'),  # in the 2023 file
+    ('alice', 2, '2023-12-30 08:00', '2023-12-30 08:10', '2024-01-03 08:00'),  # job 1 still running: not first
+    ('alice', 3, '2024-01-01 09:00', '2024-01-03 08:30', '2024-01-03 12:00'),  # job 2 still running: not first
+    ('alice', 4, '2024-01-04 09:00', '2024-01-04 09:05', '2024-01-04 10:00'),  # first job
+    ('bob', 7, '2023-12-31 10:00', '2023-12-31 10:05', '2023-12-31 12:00'),    # in the 2023 file
+    ('bob', 5, '2023-12-31 22:00', '2023-12-31 22:30', '2024-01-01 01:00'),    # first job of 2023, after job 7
+    ('bob', 6, '2024-01-02 09:00', '2024-01-02 09:20', '2024-01-02 11:00'),    # first job
+]
+EXPECTED = [4, 6]
+EXPECTED_EARLIER = [5]  # in the earlier-years output, with year 2023
+
+
+def timestamp(text):
+    return int(datetime.datetime.strptime(text, '%Y-%m-%d %H:%M').timestamp())
+
+
+def write_accounting(file_name, qname, year):
+    # One single-slot job per JOBS entry that ended in year, in ux_end_time order like the real files
+    jobs = sorted([job for job in JOBS if job[4].startswith(str(year))], key=lambda job: job[4])
+    columns = {
+        'ux_submission_time': [timestamp(job[2]) for job in jobs],
+        'ux_start_time': [timestamp(job[3]) for job in jobs],
+        'ux_end_time': [timestamp(job[4]) for job in jobs],
+        'granted_pe': ['NONE'] * len(jobs),
+        'slots': [1] * len(jobs),
+        'options': [''] * len(jobs),
+        'pe_taskid': ['NONE'] * len(jobs),
+        'qname': [qname] * len(jobs),
+        'job_number': [job[1] for job in jobs],
+        'owner': [job[0] for job in jobs],
+        'job_name': ['job'] * len(jobs),
+        'task_number': [0] * len(jobs),
+    }
+    feather.write_feather(pa.table(columns, schema=ACCOUNTING_SCHEMA), file_name)
+
+
+if __name__ == "__main__":
+    with synthetic_work_dir() as work_dir:
+        queues = queue_info()
+        input_file_name = os.path.join(work_dir, f'{YEAR}.feather')
+        previous_input_file_name = os.path.join(work_dir, f'{YEAR - 1}.feather')
+        write_accounting(input_file_name, queues['queuename'].iloc[0], YEAR)
+        write_accounting(previous_input_file_name, queues['queuename'].iloc[0], YEAR - 1)
+
+        modes = [(backend, batch_rows, None) for backend in ['pandas', 'arrow', 'polars'] for batch_rows in [None, 1]]
+        modes.append(('pandas', None, 2))
+        failures = []
+        for backend, batch_rows, shards in modes:
+            output_file_name = os.path.join(work_dir, f'{backend}_{batch_rows}_{shards}.csv')
+            waiting_time_per_job_type(input_file_name, output_file_name, YEAR, batch_rows=batch_rows, shards=shards,
+                                      workers=shards, backend=backend,
+                                      previous_input_file_name=previous_input_file_name)
+            job_numbers = sorted(read_waiting_times(output_file_name)['job_number'].tolist())
+            earlier = read_waiting_times(earlier_years_file(output_file_name, YEAR))
+            earlier_job_numbers = sorted(earlier['job_number'].tolist())
+            mode = f"{backend}, {f'batches of {batch_rows}' if batch_rows else 'full'}" + \
+                (f', {shards} shards' if shards else '')
+            print(f"{mode:<24} first jobs {job_numbers}, of {YEAR - 1} {earlier_job_numbers}")
+            if job_numbers != EXPECTED or earlier_job_numbers != EXPECTED_EARLIER or (earlier['year'] != YEAR - 1).any():
+                failures.append(mode)
+
+    if failures:
+        sys.exit(f'Expected first jobs {EXPECTED}, and {EXPECTED_EARLIER} of {YEAR - 1}, in: {failures}')
+    print('All modes agree')
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Check the quantiles merged from the waiting time sketches against the exact ones of random selections, and time them
+import os
+import sys
+import time
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import numpy as np
+import pandas as pd
+from helpers import MONTHS, JOB_TYPES, QUEUE_FILTERS, queue_filter_mask, shiny_data_file
+from sketches import WaitSketches, SKETCH_ALPHA, sketch_waiting_times
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def random_selection(rng, df):
+    # A few years, months, job classes and (half of the time) queues, and a queue filter
+    def some(values, most):
+        values = np.asarray(values)
+        return list(rng.choice(values, rng.integers(1, min(most, len(values)) + 1), replace=False))
+    qnames = some(df['qname'].cat.categories, 8) if rng.random() < 0.5 else None
+    return dict(years=some(df['year'].unique(), 3), months=some(MONTHS, 6), job_classes=some(JOB_TYPES, 3),
+                queue_filter=str(rng.choice(QUEUE_FILTERS)), qnames=qnames)
+
+
+def exact_quantiles(df, years, months, job_classes, queue_filter, qnames):
+    rows = df['year'].isin(years) & df['month'].isin(months) & df['job_class'].isin(job_classes)
+    if qnames is not None:
+        rows &= df['qname'].isin(qnames)
+    waits = df[rows]
+    waits = waits[queue_filter_mask(waits, queue_filter)]['first_job_waiting_time']
+    return waits.quantile(list(QUANTILES)).to_numpy(), len(waits)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check the sketch quantiles against the exact ones.')
+    parser.add_argument('--data-file', default=shiny_data_file('ShinyApp_Data.feather'),
+                        help='ShinyApp data to sketch (default: the live snapshot)')
+    parser.add_argument('--queries', type=int, default=500, help='Random selections to check')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the selections')
+    args = parser.parse_args()
+
+    df = pd.read_feather(args.data_file)
+    start_time = time.perf_counter()
+    sketches = WaitSketches(sketch_waiting_times(df))
+    print(f"Sketched {len(df)} waits into {len(sketches.bounds) - 1} cells in {time.perf_counter() - start_time:.2f} s")
+
+    rng = np.random.default_rng(args.seed)
+    selections = [random_selection(rng, df) for _ in range(args.queries)]
+    start_time = time.perf_counter()
+    results = [sketches.quantiles(QUANTILES, **selection) for selection in selections]
+    query_us = (time.perf_counter() - start_time) / len(selections) * 1e6
+    start_time = time.perf_counter()
+    expected = [exact_quantiles(df, **selection) for selection in selections]
+    exact_us = (time.perf_counter() - start_time) / len(selections) * 1e6
+
+    failures, worst = 0, 0.0
+    for (values, count), (exact, exact_count) in zip(results, expected):
+        values = np.array(list(values.values()))
+        if count != exact_count:
+            failures += 1
+        elif count:
+            error = np.abs(values - exact) / np.where(exact > 0, exact, 1)
+            worst = max(worst, error.max())
+            failures += bool((error > SKETCH_ALPHA + 1e-9).any())
+    print(f"{args.queries} selections: {query_us:.0f} us per sketch query, {exact_us:.0f} us from the rows, "
+          f"worst relative error {worst:.4f} (bound {SKETCH_ALPHA})")
+    if failures:
+        sys.exit(f'{failures} selections out of bounds')
+    print('All quantiles within bounds')
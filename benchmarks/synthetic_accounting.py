@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# Synthetic SGE accounting tables with the columns of the yearly /projectnb accounting feathers
+import os
+import sys
+import argparse
+import tempfile
+from contextlib import contextmanager, ExitStack
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from helpers import ACCOUNTING_COLUMNS
+
+ACCOUNTING_SCHEMA = pa.schema([
+    ('ux_submission_time', pa.int64()),
+    ('ux_start_time', pa.int64()),
+    ('ux_end_time', pa.int64()),
+    ('granted_pe', pa.string()),
+    ('slots', pa.int64()),
+    ('options', pa.string()),
+    ('pe_taskid', pa.string()),
+    ('qname', pa.string()),
+    ('job_number', pa.int64()),
+    ('owner', pa.string()),
+    ('job_name', pa.string()),
+    ('task_number', pa.int64()),
+])
+assert ACCOUNTING_SCHEMA.names == ACCOUNTING_COLUMNS
+
+# Share of jobs of each type, and the queues and parallel environments they use
+JOB_MIX = {'GPU': 0.08, '1-p': 0.55, 'MPI': 0.07, 'OMP': 0.30}
+GPU_OPTIONS = ['gpus=1', 'gpus=1,gpu_c=6.0', 'gpus=2', 'gpus=2,gpu_c=7.0', 'gpus=4', 'gpus=1,gpu_memory=16G']
+CPU_OPTIONS = ['', 'h_rt=12:00:00', 'mem_per_core=8G', 'h_rt=48:00:00,mem_per_core=4G', 'avx']
+MPI_PES = ['mpi_16_tasks_per_node', 'mpi_28_tasks_per_node', 'mpi_32_tasks_per_node', 'mpi128']
+OMP_SLOTS = [2, 4, 8, 16, 28, 32]
+ARRAY_SHARE = 0.02            # share of jobs submitted as task arrays
+ARRAY_TASKS_MEAN = 25         # mean tasks per array job (geometric, so a few arrays are much larger)
+N_QUEUES = 120
+
+
+def queue_info(n_queues=N_QUEUES, seed=0):
+    """
+    Synthetic queue_info.csv table: a few large shared queues and many
+    small buy-in queues, some of which are also open to shared users.
+    """
+    rng = np.random.default_rng(seed)
+    n_shared = max(n_queues // 10, 1)
+    class_own = np.array(['shared'] * n_shared + ['buyin'] * (n_queues - n_shared))
+    class_user = np.where((class_own == 'buyin') & (rng.random(n_queues) < 0.15), 'shared', class_own)
+    return pd.DataFrame({
+        'queuename': [f'{"s" if own == "shared" else "b"}{i:03d}' for i, own in enumerate(class_own)],
+        'class_user': class_user,
+        'class_own': class_own,
+    })
+
+
+@contextmanager
+def synthetic_work_dir(work_dir=None, seed=0):
+    """
+    Point the queue mapping (QUEUE_INFO_PATH) at the queue_info() catalog of
+    seed, written to work_dir, for the with-block, and yield work_dir. By
+    default work_dir is a new temporary directory, removed afterwards.
+    """
+    with ExitStack() as stack:
+        if work_dir is None:
+            work_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        queue_info_file_name = os.path.join(work_dir, f'queue_info_{seed}.csv')
+        queue_info(seed=seed).to_csv(queue_info_file_name, index=False)
+        previous = os.environ.get('QUEUE_INFO_PATH')
+        os.environ['QUEUE_INFO_PATH'] = queue_info_file_name
+        try:
+            yield work_dir
+        finally:
+            if previous is None:
+                del os.environ['QUEUE_INFO_PATH']
+            else:
+                os.environ['QUEUE_INFO_PATH'] = previous
+
+
+def skewed_choice(rng, n_values, size, exponent=1.2):
+    # Zipf-like draw of value indexes: a few heavy users submit most of the jobs
+    weights = 1 / np.arange(1, n_values + 1) ** exponent
+    return rng.choice(n_values, size, p=weights / weights.sum())
+
+
+def accounting_chunk(rng, n_rows, first_end_time, last_end_time, first_job_number, queues, n_owners):
+    """
+    n_rows accounting records ending between first_end_time and
+    last_end_time, sorted by ux_end_time like the SGE accounting file.
+    Array jobs have one record per task, MPI jobs one master record plus
+    one record per subtask (pe_taskid set).
+    """
+    # Jobs first; every job has at least one record, so n_rows jobs are always enough
+    n_jobs = n_rows
+    job_type = rng.choice(list(JOB_MIX), n_jobs, p=list(JOB_MIX.values()))
+    is_gpu, is_1p, is_mpi, is_omp = (job_type == name for name in JOB_MIX)
+    n_tasks = np.where(rng.random(n_jobs) < ARRAY_SHARE, rng.geometric(1 / ARRAY_TASKS_MEAN, n_jobs), 1)
+    n_subtasks = np.where(is_mpi, rng.integers(2, 9, n_jobs), 0)
+    records_per_job = n_tasks * (1 + n_subtasks)
+    n_jobs = int(np.searchsorted(np.cumsum(records_per_job), n_rows)) + 1
+    job_type, n_tasks, n_subtasks = job_type[:n_jobs], n_tasks[:n_jobs], n_subtasks[:n_jobs]
+    is_gpu, is_1p, is_mpi, is_omp = is_gpu[:n_jobs], is_1p[:n_jobs], is_mpi[:n_jobs], is_omp[:n_jobs]
+
+    owner = skewed_choice(rng, n_owners, n_jobs)
+    options = np.where(is_gpu, rng.choice(GPU_OPTIONS, n_jobs), rng.choice(CPU_OPTIONS, n_jobs)).astype(object)
+    options[rng.random(n_jobs) < 0.05] = None
+    slots = np.select([is_1p | (is_gpu & (rng.random(n_jobs) < 0.7)), is_mpi],
+                      [1, rng.choice([16, 28, 32, 64, 128, 256], n_jobs)], rng.choice(OMP_SLOTS, n_jobs))
+    granted_pe = np.select([is_mpi, slots > 1], [rng.choice(MPI_PES, n_jobs), 'omp'], 'NONE').astype(object)
+    granted_pe[(granted_pe == 'NONE') & (rng.random(n_jobs) < 0.5)] = None
+    # GPU jobs go to the shared GPU queues more often than CPU jobs; a small share is in queues that are gone
+    n_shared = int((queues['class_own'] == 'shared').sum())
+    qname = np.where(rng.random(n_jobs) < np.where(is_gpu, 0.8, 0.5), rng.integers(0, n_shared, n_jobs),
+                     skewed_choice(rng, len(queues), n_jobs, exponent=0.8))
+    qname = queues['queuename'].to_numpy(dtype=object)[qname]
+    qname[rng.random(n_jobs) < 0.002] = 'retired-queue'
+    job_name = np.char.add('job', (owner * 7 + rng.integers(0, 20, n_jobs)).astype(str)).astype(object)
+
+    # One record per array task, then per MPI subtask
+    task_job = np.repeat(np.arange(n_jobs), n_tasks)
+    task_number = np.arange(len(task_job)) - np.repeat(np.cumsum(n_tasks) - n_tasks, n_tasks) + 1
+    task_number[n_tasks[task_job] == 1] = 0
+    record_task = np.repeat(np.arange(len(task_job)), 1 + n_subtasks[task_job])
+    record_job = task_job[record_task]
+    starts = np.cumsum(1 + n_subtasks[task_job]) - (1 + n_subtasks[task_job])
+    subtask = np.arange(len(record_task)) - starts[record_task]
+    keep = slice(0, n_rows)
+    record_task, record_job, subtask = record_task[keep], record_job[keep], subtask[keep]
+
+    # End times spread over the chunk's window; run and queue times are heavy tailed
+    task_end = rng.integers(first_end_time, last_end_time, len(task_job))
+    run_time = np.minimum(rng.lognormal(7.5, 1.8, len(task_job)), 30 * 86400).astype(np.int64)
+    wait_time = np.minimum(rng.lognormal(5.0, 2.2, len(task_job)), 14 * 86400).astype(np.int64)
+    gpu_tasks = is_gpu[task_job]
+    wait_time[gpu_tasks] *= 3  # GPU queues are the busiest
+    ux_end_time = task_end[record_task]
+    ux_start_time = ux_end_time - run_time[record_task]
+    # Array tasks are submitted together and subtasks share their master's submission
+    job_submit = (task_end - run_time - wait_time)[np.cumsum(n_tasks) - n_tasks]
+    ux_submission_time = np.minimum(job_submit[record_job], ux_start_time)
+    pe_taskid = np.where(subtask > 0, subtask.astype(str), 'None').astype(object)
+    pe_taskid[(subtask == 0) & ~is_mpi[record_job]] = None
+
+    order = np.argsort(ux_end_time, kind='stable')
+    columns = {
+        'ux_submission_time': ux_submission_time,
+        'ux_start_time': ux_start_time,
+        'ux_end_time': ux_end_time,
+        'granted_pe': granted_pe[record_job],
+        'slots': slots[record_job],
+        'options': options[record_job],
+        'pe_taskid': pe_taskid,
+        'qname': qname[record_job],
+        'job_number': first_job_number + record_job,
+        'owner': np.char.add('user', owner.astype(str)).astype(object)[record_job],
+        'job_name': job_name[record_job],
+        'task_number': task_number[record_task],
+    }
+    return pa.Table.from_arrays([pa.array(columns[name][order], type=field.type)
+                                 for name, field in zip(ACCOUNTING_SCHEMA.names, ACCOUNTING_SCHEMA)],
+                                schema=ACCOUNTING_SCHEMA), first_job_number + n_jobs
+
+
+def synthetic_accounting(n_rows, year=2024, seed=0, n_owners=3000, chunk_rows=1_000_000, queues=None):
+    """
+    Yield one year of synthetic accounting records (by end time, like the
+    yearly accounting files) as Arrow tables of at most chunk_rows rows.
+    """
+    rng = np.random.default_rng(seed)
+    queues = queue_info(seed=seed) if queues is None else queues
+    year_start = int(pd.Timestamp(f'{year}-01-01', tz='US/Eastern').timestamp())
+    year_end = int(pd.Timestamp(f'{year + 1}-01-01', tz='US/Eastern').timestamp())
+    n_chunks = max(-(-n_rows // chunk_rows), 1)
+    edges = np.linspace(year_start, year_end, n_chunks + 1).astype(np.int64)
+    job_number = 1_000_000
+    for i in range(n_chunks):
+        rows = min(chunk_rows, n_rows - i * chunk_rows)
+        table, job_number = accounting_chunk(rng, rows, edges[i], edges[i + 1], job_number, queues, n_owners)
+        yield table
+
+
+def write_synthetic_accounting(file_name, n_rows, year=2024, seed=0, n_owners=3000, chunk_rows=1_000_000,
+                               queue_info_file_name=None):
+    """
+    Write n_rows synthetic records to a Feather (Arrow IPC) file one chunk at
+    a time, so files larger than memory can be generated. With
+    queue_info_file_name, the matching queue_info.csv is written as well.
+    """
+    queues = queue_info(seed=seed)
+    if queue_info_file_name:
+        queues.to_csv(queue_info_file_name, index=False)
+    tmp_file_name = file_name + '.tmp'
+    with pa.OSFile(tmp_file_name, 'wb') as sink, pa.ipc.new_file(sink, ACCOUNTING_SCHEMA) as writer:
+        for table in synthetic_accounting(n_rows, year, seed, n_owners, chunk_rows, queues):
+            writer.write_table(table)
+    os.replace(tmp_file_name, file_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate a synthetic SGE accounting feather file.')
+    parser.add_argument('rows', type=int, help='Number of accounting records')
+    parser.add_argument('output', help='Feather file to write')
+    parser.add_argument('--year', type=int, default=2024, help='Year the jobs end in')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--owners', type=int, default=3000, help='Number of distinct owners')
+    parser.add_argument('--queue-info', default=None, help='Also write the matching queue_info.csv here')
+    args = parser.parse_args()
+
+    write_synthetic_accounting(args.output, args.rows, args.year, args.seed, args.owners,
+                               queue_info_file_name=args.queue_info)
+    print(f"{args.rows} synthetic accounting records for {args.year} saved to {args.output}")
@@ -3,3 +3,6 @@
 cd /projectnb/rcs-intern/Jiazheng/accounting/qwt
 
 qsub jobSubmit.qsub
+
+# Scatter/gather alternative: recompute the year as 16 owner-shard array tasks plus a merge task
+# python scatter.py submit --shards 16
@@ -5,10 +5,15 @@ from shinywidgets import output_widget, render_plotly
 import plotly.express as px
 import plotly.graph_objects as go  # For empty Figure
 import datetime
+import os
+from helpers import job_type_labels, current_snapshot_dir, rollup_stats, queue_filter_mask, ROLLUP_FILE
 now = datetime.datetime.now()
 
 # DATA LOADING & PREP
-dataset = pd.read_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_GPU.feather")
+# The rows and the rollup (per month stats) of the same snapshot
+data_dir = current_snapshot_dir()
+dataset = pd.read_feather(os.path.join(data_dir, "ShinyApp_Data_GPU.feather"))
+rollup = pd.read_feather(os.path.join(data_dir, ROLLUP_FILE))
 
 # Ensure 'year' column is integer
 dataset["year"] = dataset["year"].astype(int)
@@ -182,26 +187,29 @@ def gpu_job_server(input, output, session, selected_year, selected_month):
     """
 
     # ------------------ Reactive Filter ------------------
+    # The year, month, job class and queue filter of the page; None until a valid year and month are picked
     @reactive.Calc
-    def gpu_data():
+    def selection():
         try:
             year = int(input.selected_year_gpu())
         except ValueError:
-            return dataset.iloc[0:0]
+            return None
 
         month = input.selected_month_gpu().capitalize()
         if month not in month_order:
-            return dataset.iloc[0:0]
+            return None
 
-        df = dataset[(dataset["year"] == year) & (dataset["month"] == month)]
+        return year, month, "GPU", input.queue_filter_gpu()
 
-        queue_filter = input.queue_filter_gpu()
-        if queue_filter == "shared":
-            df = df[df["class_own"] == "shared"]
-        elif queue_filter == "buyin":
-            df = df[(df["class_own"] == "buyin") & (df["class_user"] == "buyin")]
+    @reactive.Calc
+    def gpu_data():
+        s = selection()
+        if s is None:
+            return dataset.iloc[0:0]
 
-        return df
+        year, month, _, queue_filter = s
+        df = dataset[(dataset["year"] == year) & (dataset["month"] == month)]
+        return df[queue_filter_mask(df, queue_filter)]
 
     # ------------------ Summary Stats ------------------
     @reactive.Calc
@@ -210,18 +218,19 @@ def gpu_job_server(input, output, session, selected_year, selected_month):
         Calculate min, max, mean, median, and count for first_job_waiting_time
         (in minutes). Returns a dictionary of stats.
         """
-        df = gpu_data()
-        if df.empty:
+        # The selection of gpu_data, looked up in the rollup instead of filtering the rows
+        s = selection()
+        s = rollup_stats(rollup, *s) if s is not None else {"count": 0}
+        if s["count"] == 0:
             return {"min": None, "max": None, "mean": None, "median": None, "count": 0}
 
         # Convert from seconds -> minutes
-        times_min = df["first_job_waiting_time"] / 60.0
         return {
-            "min": max(times_min.min(), 0),
-            "max": times_min.max(),
-            "mean": times_min.mean(),
-            "median": times_min.median(),
-            "count": df.shape[0],
+            "min": max(s["min"] / 60.0, 0),
+            "max": s["max"] / 60.0,
+            "mean": s["mean"] / 60.0,
+            "median": s["median"] / 60.0,
+            "count": s["count"],
         }
 
     # ------------------ Value Box Renderers ------------------
@@ -278,18 +287,21 @@ def gpu_job_server(input, output, session, selected_year, selected_month):
         df = df[df["first_job_waiting_time"] >= 0].copy()
         df["first_job_waiting_time"] = df["first_job_waiting_time"] / 60  # Now in minutes
 
+        # Label the jobs being plotted ("GPU = 1 {qname}", "GPU > 1 {qname}")
+        df["job_type"] = job_type_labels(df)
+
         # Compute median waiting time
-        medians = df.groupby("job_type")["first_job_waiting_time"].median().reset_index()
+        medians = df.groupby("job_type", observed=True)["first_job_waiting_time"].median().reset_index()
 
         # Get top 5 job_types with highest median
         top5 = medians.nlargest(5, "first_job_waiting_time")["job_type"].tolist()
 
         # Reassign job_type: keep top 5 as-is, label others as 'others'
-        df["job_type_grouped"] = df["job_type"].apply(lambda x: x if x in top5 else "others")
+        df["job_type_grouped"] = df["job_type"].cat.set_categories(top5).cat.add_categories("others").fillna("others")
 
         # Group again using the new column
         grouped = (
-            df.groupby("job_type_grouped")["first_job_waiting_time"]
+            df.groupby("job_type_grouped", observed=True)["first_job_waiting_time"]
             .median()
             .reset_index()
             .sort_values(by="first_job_waiting_time", ascending=True)
@@ -347,16 +359,14 @@ def gpu_job_server(input, output, session, selected_year, selected_month):
 
         # Clean and convert 'day' column
         df_plot["day"] = pd.to_numeric(df_plot["day"], errors="coerce")
-        df_plot.dropna(subset=["day", "first_job_waiting_time", "job_type"], inplace=True)
+        df_plot.dropna(subset=["day", "first_job_waiting_time", "gpu_bucket"], inplace=True)
         df_plot["day"] = df_plot["day"].astype(int)
 
         # Convert waiting time to hours
         df_plot["job_waiting_time (min)"] = df_plot["first_job_waiting_time"] / 60
 
-        # Simplify job_type into categories
-        df_plot["job_type"] = df_plot["job_type"].apply(
-            lambda x: "GPU = 1" if str(x).startswith("GPU = 1") else ("GPU > 1" if str(x).startswith("GPU") else x)
-        )
+        # GPU = 1 or GPU > 1
+        df_plot["job_type"] = df_plot["gpu_bucket"].cat.rename_categories(lambda bucket: f"GPU {bucket}")
 
         # Group by day and job type, then compute median
         grouped = (
@@ -1,32 +1,546 @@
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from pyarrow import fs
+import os
+import json
+import tempfile
 import datetime
 
-def determine_job_type(df): 
-    def get_job_type(row):
-        if row['options'] and 'gpus=' in row['options']:
-            return 'GPU'
-        elif row['slots'] == 1:
-            return '1-p'
-        elif row['granted_pe'] is not None and any(keyword in row['granted_pe'] for keyword in ['tasks_per_node', 'mpi_', 'mpi128']):
-            return 'MPI'
-        else:
-            return 'OMP'
-
-    df['job_type'] = df.apply(get_job_type, axis=1)
+ACCOUNTING_COLUMNS = ['ux_submission_time', 'ux_start_time', 'ux_end_time', 'granted_pe', 'slots', 'options',
+                      'pe_taskid', 'qname', 'job_number', 'owner', 'job_name', 'task_number']
+
+JOB_TYPES = ['GPU', '1-p', 'MPI', 'OMP']
+MPI_PE_PATTERN = 'tasks_per_node|mpi_|mpi128'
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+# QUEUE_INFO_PATH in the environment points the queue mapping at another catalog (e.g. a synthetic one). It is read
+# whenever the catalog is looked up, so it can be set after helpers is imported
+QUEUE_INFO_PATH = '/projectnb/scv/utilization/katia/queue_info.csv'
+_queue_catalogs = {}  # queue_info_path -> (mtime_ns, queue_catalog)
+
+# process_waiting_times publishes the ShinyApp data files as versioned snapshot directories under SNAPSHOT_DIR;
+# current.json names the live one
+SHINY_DATA_DIR = '/projectnb/rcs-intern/Jiazheng/accounting'
+SNAPSHOT_DIR = os.path.join(SHINY_DATA_DIR, 'ShinyApp_snapshots')
+# Partitioned Parquet dataset of every year's first-job waiting times, written by GetQueueTime.py --dataset
+DATASET_DIR = os.path.join(SHINY_DATA_DIR, 'waiting_times_dataset')
+
+# Latest end time of every (owner, job_type): the state carried between batches, runs and years
+STATE_COLUMNS = ['owner', 'job_type', 'latest_end_time']
+
+# Number of GPUs a GPU job asked for, as in the old 'GPU = 1 {qname}' and 'GPU > 1 {qname}' labels
+GPU_BUCKETS = ['= 1', '> 1']
+LABEL_COLUMNS = ['job_class', 'gpu_bucket', 'qname']
+
+# Schema of the waiting time files written by GetQueueTime: dictionary-encoded labels and the narrowest ints that fit.
+# job_class and gpu_bucket have fixed categories, so years concatenate without re-encoding; gpu_bucket is null
+# for jobs that are not GPU jobs. job_type_labels() builds the display labels from job_class/gpu_bucket/qname.
+OUTPUT_DTYPES = {
+    'job_class': pd.CategoricalDtype(JOB_TYPES),
+    'gpu_bucket': pd.CategoricalDtype(GPU_BUCKETS),
+    'qname': 'category',
+    'class_user': 'category',
+    'class_own': 'category',
+    'first_job_waiting_time': 'int32',
+    'month': pd.CategoricalDtype(MONTHS, ordered=True),
+    'year': 'uint16',
+    'day': 'uint8',
+    'job_number': 'int64',
+    'slots': 'int16',
+}
+# Columns of outputs whose array jobs were collapsed into one row each (see collapse_array_tasks): the number of
+# tasks and the wait of the task that started last. Rows of other outputs are single tasks, so on read these are
+# filled in as 1 task whose last wait is its wait.
+ARRAY_DTYPES = {'tasks': 'int32', 'last_task_waiting_time': 'int32'}
+
+# The all-job waiting times output: the same columns for every job with a valid waiting time, with its owner and
+# whether it was a first job (the rows of the first-job output). Its waits are not only first-job waits, so the
+# column is waiting_time
+ALL_JOB_DTYPES = {**{'waiting_time' if name == 'first_job_waiting_time' else name: dtype
+                     for name, dtype in OUTPUT_DTYPES.items()}, 'owner': 'category', 'first_job': 'bool'}
+LABEL_PREFIXES = {('GPU', '= 1'): 'GPU = 1', ('GPU', '> 1'): 'GPU > 1', ('MPI', None): 'MPI job'}
+
+# Queue filters of the job class pages: every job, jobs on shared queues, or buy-in jobs run by their buy-in users
+QUEUE_FILTERS = ['all', 'shared', 'buyin']
+
+# Pre-aggregated waiting times of the ShinyApp data, written by process_waiting_times into every snapshot: the count,
+# sum, sum of squares, min, max and median of the waits per (year, month, job_class, queue_filter), and per day,
+# qname and (day, qname) within those. day 0 and a null qname are the rows over all days and all queues.
+ROLLUP_KEYS = ['year', 'month', 'job_class', 'queue_filter', 'day', 'qname']
+ROLLUP_LEVELS = [[], ['day'], ['qname'], ['day', 'qname']]
+ROLLUP_DTYPES = {
+    'year': 'uint16',
+    'month': pd.CategoricalDtype(MONTHS, ordered=True),
+    'job_class': pd.CategoricalDtype(JOB_TYPES),
+    'queue_filter': pd.CategoricalDtype(QUEUE_FILTERS),
+    'day': 'uint8',
+    'qname': 'category',
+    'count': 'int64',
+    'sum': 'int64',
+    'sum_sq': 'float64',
+    'min': 'int32',
+    'max': 'int32',
+    'median': 'float64',
+}
+ROLLUP_FILE = 'ShinyApp_Rollup.feather'
+
+
+def label_prefix(job_class, gpu_bucket):
+    # 'GPU = 1', 'GPU > 1', 'MPI job', '1-p' or 'OMP'
+    return LABEL_PREFIXES.get((job_class, gpu_bucket if job_class == 'GPU' else None), job_class)
+
+
+def job_type_labels(df):
+    """
+    The old job_type labels ('GPU = 1 {qname}', 'MPI job {qname}', 'OMP {qname}'...)
+    of a DataFrame with LABEL_COLUMNS, as a categorical. Each distinct
+    (job_class, gpu_bucket, qname) is formatted once and broadcast through the
+    category codes, so only the rows being displayed ever need a label.
+    """
+    codes = [df[column].cat.codes.to_numpy(dtype=np.int64) + 1 for column in LABEL_COLUMNS]  # 0: missing
+    sizes = [len(df[column].cat.categories) + 1 for column in LABEL_COLUMNS]
+    groups, keys = pd.factorize((codes[0] * sizes[1] + codes[1]) * sizes[2] + codes[2])
+    values = []
+    for column, size in zip(reversed(LABEL_COLUMNS), reversed(sizes)):
+        categories = np.append(None, np.asarray(df[column].cat.categories, dtype=object))
+        values.insert(0, categories[keys % size])
+        keys = keys // size
+    # A missing qname reads 'nan', as it did in the labels written by the ETL
+    labels = [None if job_class is None else
+              f"{label_prefix(job_class, gpu_bucket)} {'nan' if qname is None else qname}"
+              for job_class, gpu_bucket, qname in zip(*values)]
+    label_codes, label_categories = pd.factorize(np.asarray(labels, dtype=object))
+    return pd.Series(pd.Categorical.from_codes(label_codes[groups], label_categories), index=df.index, name='job_type')
+
+
+def split_job_type_labels(labels):
+    """
+    LABEL_COLUMNS of outputs written before they existed, parsed from their
+    job_type labels; each distinct label is parsed once.
+    """
+    label_codes, distinct = pd.factorize(labels)
+    parts = {column: [] for column in LABEL_COLUMNS}
+    for label in distinct:
+        prefix = next((prefix for prefix in ['GPU = 1', 'GPU > 1', 'MPI job', '1-p', 'OMP']
+                       if label.startswith(prefix + ' ')), None)
+        job_class = {'GPU = 1': 'GPU', 'GPU > 1': 'GPU', 'MPI job': 'MPI'}.get(prefix, prefix)
+        parts['job_class'].append(job_class)
+        parts['gpu_bucket'].append(prefix[4:] if job_class == 'GPU' else None)
+        parts['qname'].append(label[len(prefix) + 1:] if prefix else None)
+    columns = {}
+    for column, values in parts.items():
+        distinct_values = pd.Categorical(values, dtype=OUTPUT_DTYPES[column] if column != 'qname' else None)
+        columns[column] = pd.Categorical.from_codes(np.append(distinct_values.codes, -1)[label_codes],
+                                                    dtype=distinct_values.dtype)
+    return pd.DataFrame(columns, index=labels.index)
+
+
+def with_label_columns(df):
+    # Outputs written before LABEL_COLUMNS existed only have job_type labels: split them (see split_job_type_labels)
+    if 'job_type' in df.columns and 'job_class' not in df.columns:
+        df = pd.concat([split_job_type_labels(df.pop('job_type')), df], axis=1)
+    return df
+
+
+def with_waiting_time_column(df, dtypes):
+    # all_jobs outputs written before ALL_JOB_DTYPES had waiting_time have it as first_job_waiting_time
+    if 'waiting_time' in dtypes and 'first_job_waiting_time' in df.columns:
+        df = df.rename(columns={'first_job_waiting_time': 'waiting_time'})
+    return df
+
+
+def with_array_columns(df, dtypes):
+    # dtypes with ARRAY_DTYPES added when df has collapsed array jobs; rows written without them are single tasks
+    if 'tasks' not in df.columns:
+        return df, dtypes
+    df['tasks'] = df['tasks'].fillna(1)
+    waiting_time = 'waiting_time' if 'waiting_time' in df.columns else 'first_job_waiting_time'
+    df['last_task_waiting_time'] = df['last_task_waiting_time'].fillna(df[waiting_time])
+    return df, {**dtypes, **ARRAY_DTYPES}
+
+
+def read_waiting_times(file_name, year=None, dtypes=OUTPUT_DTYPES):
+    """
+    Load a GetQueueTime output (.feather, .csv or a partitioned Parquet dataset
+    directory) with the OUTPUT_DTYPES schema (ALL_JOB_DTYPES for the all-job
+    output). For a dataset, year only reads that year's partition. Outputs
+    with the older job_type labels are read with LABEL_COLUMNS parsed from
+    the labels. Outputs with collapsed array jobs also get ARRAY_DTYPES.
+    """
+    if file_name.endswith('.feather'):
+        df = with_waiting_time_column(with_label_columns(pd.read_feather(file_name)), dtypes)
+        df, dtypes = with_array_columns(df, dtypes)
+        return df.astype(dtypes)
+    if file_name.endswith('.csv'):
+        df = pd.read_csv(file_name, dtype={**dtypes, **ARRAY_DTYPES, 'job_type': 'category'})
+        df, dtypes = with_array_columns(with_waiting_time_column(with_label_columns(df), dtypes), dtypes)
+        return df.astype(dtypes)
+    dataset = ds.dataset(file_name, format='parquet', partitioning='hive')
+    row_filter = None
+    if year is not None:
+        # A year's files may not have the schema of the first file of the whole dataset
+        files = [path for path in dataset.files if f'{os.sep}year={year}{os.sep}' in path]
+        if not files:
+            return pd.DataFrame(columns=list(dtypes)).astype(dtypes)
+        dataset = ds.dataset(files, format='parquet', partitioning=ds.HivePartitioning.discover(),
+                             partition_base_dir=file_name)
+        row_filter = ds.field('year') == year
+    columns = [name for name in dataset.schema.names
+               if name in dtypes or name in ARRAY_DTYPES or name in ('job_type', 'first_job_waiting_time')]
+    df = dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+    df, dtypes = with_array_columns(with_waiting_time_column(with_label_columns(df), dtypes), dtypes)
+    return df[list(dtypes)].astype(dtypes)
+
+
+def earlier_years_file(output_file_name, year):
+    """
+    Where the GetQueueTime run of year writes the first jobs of its accounting
+    file that were submitted in an earlier year (they ran over new year's),
+    for the consolidation of their own year to add: next to a yearly output,
+    in the same format, or one Feather file per year next to a dataset.
+    """
+    if output_file_name.endswith(('.csv', '.feather')):
+        root, ext = os.path.splitext(output_file_name)
+        return f'{root}_earlier_years{ext}'
+    return os.path.join(f'{output_file_name.rstrip(os.sep)}_earlier_years', f'{year}.feather')
+
+
+def current_snapshot_dir(snapshot_dir=SNAPSHOT_DIR):
+    """
+    Directory of the live ShinyApp data snapshot. A published snapshot is
+    never written to again, so its files can be read or memory-mapped without
+    locks; read all the files of a page from the same directory to get one
+    consistent version. Before the first snapshot, the flat SHINY_DATA_DIR.
+    """
+    try:
+        with open(os.path.join(snapshot_dir, 'current.json')) as pointer_file:
+            return os.path.join(snapshot_dir, json.load(pointer_file)['version'])
+    except FileNotFoundError:
+        return os.path.dirname(snapshot_dir)
+
+
+def shiny_data_file(name, snapshot_dir=SNAPSHOT_DIR):
+    # e.g. shiny_data_file('ShinyApp_Data_GPU.feather'), in the live snapshot
+    return os.path.join(current_snapshot_dir(snapshot_dir), name)
+
+
+def queue_filter_mask(df, queue_filter):
+    # Rows of df in queue_filter, as selected on the job class pages
+    if queue_filter == 'shared':
+        return (df['class_own'] == 'shared').to_numpy()
+    if queue_filter == 'buyin':
+        return ((df['class_own'] == 'buyin') & (df['class_user'] == 'buyin')).to_numpy()
+    return np.ones(len(df), dtype=bool)
+
+
+def rollup_view(rollup, year, month, job_class, queue_filter='all', by=()):
+    """
+    Rows of the rollup for one page selection, indexed by by (a subset of
+    ['day', 'qname']; empty for the totals of the month), with the mean
+    added. All values are in seconds.
+    """
+    rows = rollup[(rollup['year'] == year) & (rollup['month'] == month) & (rollup['job_class'] == job_class)
+                  & (rollup['queue_filter'] == queue_filter)]
+    rows = rows[(rows['day'] > 0) if 'day' in by else (rows['day'] == 0)]
+    rows = rows[rows['qname'].notna() if 'qname' in by else rows['qname'].isna()]
+    rows = rows.assign(mean=rows['sum'] / rows['count'])
+    return rows.set_index(list(by)).sort_index() if by else rows
+
+
+def rollup_stats(rollup, year, month, job_class, queue_filter='all'):
+    # min, max, mean, median (seconds) and count of one page selection; None for the values of an empty selection
+    rows = rollup_view(rollup, year, month, job_class, queue_filter)
+    if rows.empty:
+        return {'min': None, 'max': None, 'mean': None, 'median': None, 'count': 0}
+    row = rows.iloc[0]
+    return {'min': row['min'], 'max': row['max'], 'mean': row['mean'], 'median': row['median'],
+            'count': int(row['count'])}
+
+
+def merge_latest_end_times(*states):
+    # Combine latest_end_times DataFrames, keeping the latest end time per (owner, job_type)
+    states = [state for state in states if state is not None and len(state)]
+    if not states:
+        return pd.DataFrame(columns=STATE_COLUMNS).astype({'latest_end_time': np.int64})
+    return (pd.concat(states, ignore_index=True)
+            .groupby(['owner', 'job_type'], sort=False, dropna=False)['latest_end_time'].max()
+            .reset_index())
+
+
+def mpi_subtask_filter(schema):
+    """
+    Arrow expression that keeps everything except MPI subtask records: 'mpi'
+    in granted_pe and a valid pe_taskid (not null and not the string 'None').
+    Nulls are folded to False so they never drop a row by themselves.
+    """
+    is_mpi = pc.coalesce(pc.match_substring(ds.field('granted_pe'), 'mpi'), pa.scalar(False))
+    has_taskid = ds.field('pe_taskid').is_valid()
+    if pa.types.is_string(schema.field('pe_taskid').type) or pa.types.is_large_string(schema.field('pe_taskid').type):
+        has_taskid = has_taskid & pc.coalesce(ds.field('pe_taskid') != 'None', pa.scalar(False))
+    return ~(is_mpi & has_taskid)
+
+
+def read_accounting(input_file_name, columns=ACCOUNTING_COLUMNS, min_end_time=None, as_table=False):
+    """
+    Read a yearly accounting feather file with the column projection and the
+    MPI subtask filter pushed down into the Arrow scan. The file is memory
+    mapped, so columns that are not requested are never read or decoded, and
+    filtered batches are converted to pandas without keeping a second copy.
+    With min_end_time, only records that ended strictly after it are read.
+    as_table returns the Arrow table instead of a DataFrame.
+    """
+    dataset = ds.dataset(input_file_name, format='feather', filesystem=fs.LocalFileSystem(use_mmap=True))
+    row_filter = mpi_subtask_filter(dataset.schema)
+    if min_end_time is not None:
+        row_filter = row_filter & (ds.field('ux_end_time') > min_end_time)
+    table = dataset.to_table(columns=columns, filter=row_filter)
+    if as_table:
+        return table
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def iter_accounting_tables(input_file_name, batch_rows, columns=ACCOUNTING_COLUMNS, min_end_time=None):
+    """
+    Read an accounting feather file as Arrow tables of batch_rows rows (the
+    last one can be smaller), in file order, with the same column projection
+    and filters as read_accounting. Record batches larger than batch_rows are
+    read in slices, so only about batch_rows records are filtered at a time.
+    """
+    source = pa.memory_map(input_file_name)
+    schema = pa.ipc.open_file(source).schema
+    needed = list(dict.fromkeys(columns + ['ux_end_time', 'granted_pe', 'pe_taskid']))
+    reader = pa.ipc.open_file(source, options=pa.ipc.IpcReadOptions(
+        included_fields=[schema.get_field_index(name) for name in needed]))
+    row_filter = mpi_subtask_filter(reader.schema)
+    if min_end_time is not None:
+        row_filter = row_filter & (ds.field('ux_end_time') > min_end_time)
+
+    pending, pending_rows, yielded = [], 0, False
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i)  # memory mapped: a slice only reads its own rows
+        for offset in range(0, batch.num_rows, batch_rows):
+            table = pa.Table.from_batches([batch.slice(offset, batch_rows)]).filter(row_filter).select(columns)
+            pending.append(table)
+            pending_rows += table.num_rows
+            if pending_rows >= batch_rows:
+                # Keep the rows past batch_rows for the next table, so filtered slices never add up to more
+                table = pa.concat_tables(pending)
+                yield table.slice(0, batch_rows)
+                pending, pending_rows, yielded = [table.slice(batch_rows)], pending_rows - batch_rows, True
+    if pending_rows or not yielded:
+        yield pa.concat_tables(pending) if pending else reader.schema.empty_table().select(columns)
+
+
+def end_time_buckets(input_file_name, batch_rows, min_end_time=None):
+    """
+    First pass of stream_accounting: count records per hour of ux_end_time and
+    group consecutive hours into buckets of at most batch_rows records (an
+    hour with more records than that gets a bucket of its own). Returns the
+    bucket start times, or None when the file is already sorted by ux_end_time.
+    """
+    hourly = []
+    is_sorted, last_end = True, None
+    for table in iter_accounting_tables(input_file_name, batch_rows, ['ux_end_time'], min_end_time):
+        end_time = table['ux_end_time'].to_numpy()
+        if len(end_time) == 0:
+            continue
+        if is_sorted:
+            is_sorted = bool((np.diff(end_time) >= 0).all()) and (last_end is None or end_time[0] >= last_end)
+            last_end = end_time[-1]
+        hourly.append(pd.Series(end_time // 3600).value_counts())
+    if is_sorted or not hourly:
+        return None
+
+    counts = pd.concat(hourly).groupby(level=0).sum().sort_index()
+    edges, bucket_rows = [], 0
+    for hour, count in counts.items():
+        if not edges or bucket_rows + count > batch_rows:
+            edges.append(hour * 3600)
+            bucket_rows = 0
+        bucket_rows += count
+    return np.asarray(edges)
+
+
+def stream_accounting(input_file_name, batch_rows, min_end_time=None, spill_dir=None, as_table=False):
+    """
+    Read an accounting feather file as pandas DataFrames of about batch_rows
+    rows that together come in ux_end_time order, so peak memory does not
+    depend on the size of the year.
+
+    Files that are not sorted by ux_end_time are sorted externally: rows are
+    spilled to one Arrow file per end_time_buckets bucket under spill_dir
+    (default: the system temp dir), then each bucket is read back in turn.
+    Rows keep their file order within a bucket, so a stable sort of each
+    DataFrame gives the same order as sorting the whole file. Rows with the
+    same ux_end_time always come in the same DataFrame.
+    as_table yields the Arrow tables instead of DataFrames.
+    """
+    edges = end_time_buckets(input_file_name, batch_rows, min_end_time)
+    if edges is None:
+        # Hold back the rows that tie with the last end time of a batch, so a batch never ends in the middle of
+        # a tie and its max ux_end_time is a safe watermark to resume from
+        held_back, yielded = None, False
+        for table in iter_accounting_tables(input_file_name, batch_rows, min_end_time=min_end_time):
+            if held_back is not None:
+                table = pa.concat_tables([held_back, table])
+            end_time = table['ux_end_time'].to_numpy()
+            split = int(np.searchsorted(end_time, end_time[-1], side='left')) if len(end_time) else 0
+            held_back = table.slice(split)
+            if split:
+                batch = table.slice(0, split)  # no self_destruct below: held_back shares its buffers
+                yield batch if as_table else batch.to_pandas(split_blocks=True)
+                yielded = True
+        if held_back.num_rows or not yielded:
+            yield held_back if as_table else held_back.to_pandas(split_blocks=True)
+        return
+
+    with tempfile.TemporaryDirectory(prefix='accounting_spill_', dir=spill_dir) as spill:
+        paths = [os.path.join(spill, f'{bucket}.arrow') for bucket in range(len(edges))]
+        writers = {}
+        for table in iter_accounting_tables(input_file_name, batch_rows, min_end_time=min_end_time):
+            bucket = np.searchsorted(edges, table['ux_end_time'].to_numpy(), side='right') - 1
+            for b in np.unique(bucket):
+                if b not in writers:
+                    writers[b] = pa.ipc.new_file(paths[b], table.schema)
+                writers[b].write_table(table.filter(pa.array(bucket == b)))
+        for writer in writers.values():
+            writer.close()
+
+        for b in sorted(writers):
+            table = pa.ipc.open_file(pa.memory_map(paths[b])).read_all()
+            yield table if as_table else table.to_pandas(split_blocks=True, self_destruct=True)
+            del table
+            os.remove(paths[b])
+
+
+def collapse_array_tasks(table):
+    """
+    Replace the records of the tasks of every array job (task_number > 0) by
+    one record per job: (owner, job_number, ux_submission_time), as tasks of
+    the same array share their submission time and job numbers wrap around.
+    The job started when its first task started and ended when its last task
+    ended; tasks and ux_last_start_time keep the number of tasks and when the
+    last one started. Other records get 1 task. Each job takes the place and
+    the other columns (qname, slots...) of its first record in the table, so
+    the order of ties stays the same from one run to the next.
+    """
+    task_number = pc.fill_null(table['task_number'], 0).to_numpy()
+    tasks = pd.DataFrame({
+        'owner': table['owner'].to_numpy(zero_copy_only=False),
+        'job_number': table['job_number'].to_numpy(zero_copy_only=False),
+        'ux_submission_time': table['ux_submission_time'].to_numpy(),
+        'ux_start_time': table['ux_start_time'].to_numpy(),
+        'ux_end_time': table['ux_end_time'].to_numpy(),
+    })[task_number > 0]
+    jobs = (tasks.reset_index().groupby(['owner', 'job_number', 'ux_submission_time'], sort=False, dropna=False)
+            .agg(row=('index', 'min'), tasks=('index', 'size'), ux_start_time=('ux_start_time', 'min'),
+                 ux_last_start_time=('ux_start_time', 'max'), ux_end_time=('ux_end_time', 'max')))
+
+    keep = task_number <= 0
+    keep[jobs['row'].to_numpy()] = True
+    rows = np.flatnonzero(keep)
+    job_rows = np.searchsorted(rows, jobs['row'].to_numpy())  # where each job's record lands in the result
+    columns = {
+        'tasks': np.ones(len(rows), dtype=np.int64),
+        'ux_start_time': table['ux_start_time'].to_numpy()[rows],
+        'ux_end_time': table['ux_end_time'].to_numpy()[rows],
+    }
+    columns['ux_last_start_time'] = columns['ux_start_time'].copy()
+    for name in columns:
+        columns[name][job_rows] = jobs[name].to_numpy()
+    table = table.take(rows)
+    for name in ['ux_start_time', 'ux_end_time']:
+        table = table.set_column(table.schema.get_field_index(name), name,
+                                 pa.array(columns[name], type=table.schema.field(name).type))
+    return table.append_column('tasks', pa.array(columns['tasks'])).append_column(
+        'ux_last_start_time', pa.array(columns['ux_last_start_time'], type=table.schema.field('ux_start_time').type))
+
+
+def local_utc_offset(timestamp):
+    # Seconds the local timezone is ahead of UTC at this instant, exactly as datetime.fromtimestamp sees it
+    local = datetime.datetime.fromtimestamp(timestamp)
+    utc = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).replace(tzinfo=None)
+    return int((local - utc).total_seconds())
+
+
+def local_seconds(timestamps):
+    # Unix timestamps shifted by the local UTC offset, looked up once per distinct 15-minute bucket
+    seconds = np.asarray(timestamps, dtype=np.int64)
+    buckets, uniques = pd.factorize(seconds // 900)
+    offsets = np.array([local_utc_offset(int(bucket) * 900) for bucket in uniques], dtype=np.int64)
+    return seconds + offsets[buckets]
+
+
+def submission_calendar(timestamps):
+    """
+    Split a column of unix timestamps into local year, month ('%b' abbreviation,
+    as an ordered categorical) and day, matching datetime.fromtimestamp.
+    The local UTC offset only changes at DST transitions, which fall on
+    quarter hours, so it is looked up once per distinct 15-minute bucket
+    instead of once per row.
+    """
+    local = pd.DatetimeIndex(pd.to_datetime(local_seconds(timestamps), unit='s'))
+
+    return pd.DataFrame({
+        'year': local.year,
+        'month': pd.Categorical.from_codes(local.month - 1, categories=MONTHS, ordered=True),
+        'day': local.day,
+    }, index=getattr(timestamps, 'index', None))
+
+
+def str_contains(series, pattern, regex=False):
+    # Accounting strings repeat a lot, so match each distinct value once and broadcast the result back
+    codes, uniques = pd.factorize(series)
+    matches = pd.Series(uniques, dtype=object).str.contains(pattern, regex=regex, na=False).to_numpy(dtype=bool)
+    return np.append(matches, False)[codes]  # code -1 (missing) picks the trailing False
+
+
+def determine_job_type(df):
+    # Same precedence as the old per-row rules: GPU, then 1-p, then MPI, otherwise OMP
+    codes = np.full(len(df), JOB_TYPES.index('OMP'), dtype=np.int8)
+    codes[str_contains(df['granted_pe'], MPI_PE_PATTERN, regex=True)] = JOB_TYPES.index('MPI')
+    codes[df['slots'].eq(1).to_numpy()] = JOB_TYPES.index('1-p')
+    codes[str_contains(df['options'], 'gpus=')] = JOB_TYPES.index('GPU')
+
+    df['job_type'] = pd.Categorical.from_codes(codes, categories=JOB_TYPES)
     return df
 
     
-def check_shared_buyin(df):
-    # Load the queue information from the CSV file
-    queue_info_path = '/projectnb/scv/utilization/katia/queue_info.csv'
-    queue_info = pd.read_csv(queue_info_path)
+def queue_catalog(queue_info_path=None):
+    """
+    Queue information indexed by queue name, with class_user and class_own as
+    categoricals. The CSV is parsed once and cached until its mtime changes.
+    """
+    queue_info_path = queue_info_path or os.environ.get('QUEUE_INFO_PATH', QUEUE_INFO_PATH)
+    mtime = os.stat(queue_info_path).st_mtime_ns
+    cached = _queue_catalogs.get(queue_info_path)
+    if cached is None or cached[0] != mtime:
+        # Load the queue information from the CSV file; like a dict, the last row of a repeated queue name wins
+        queue_info = pd.read_csv(queue_info_path).drop_duplicates('queuename', keep='last')
+        catalog = pd.DataFrame({
+            'class_user': pd.Categorical(queue_info['class_user']),
+            'class_own': pd.Categorical(queue_info['class_own']),
+        }, index=pd.Index(queue_info['queuename'], name='qname'))
+        cached = _queue_catalogs[queue_info_path] = (mtime, catalog)
+    return cached[1]
+
+
+def check_shared_buyin(df, queue_info_path=None):
+    catalog = queue_catalog(queue_info_path)
 
-    class_user_dict = dict(zip(queue_info['queuename'], queue_info['class_user']))
-    class_own_dict = dict(zip(queue_info['queuename'], queue_info['class_own']))
+    # Look up each distinct qname once, then broadcast the catalog row number to every job
+    qname_codes, qnames = pd.factorize(df['qname'])
+    df['qname'] = pd.Categorical.from_codes(qname_codes, qnames)
+    rows = np.append(catalog.index.get_indexer(qnames), -1)[qname_codes]  # -1: unknown queue (or missing qname)
 
     # Map class_user and class_own to the main DataFrame based on 'qname'
-    df['class_user'] = df['qname'].map(class_user_dict)
-    df['class_own'] = df['qname'].map(class_own_dict)
+    for column in ['class_user', 'class_own']:
+        classes = catalog[column].array
+        codes = np.where(rows >= 0, classes.codes[rows], -1)
+        df[column] = pd.Categorical.from_codes(codes, dtype=classes.dtype)
 
     return df
@@ -5,27 +5,16 @@ from shinywidgets import output_widget, render_plotly
 import plotly.express as px
 import plotly.graph_objects as go
 import datetime
+from helpers import shiny_data_file
 
 
 # Load data
-dataset = pd.read_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data.feather")
+dataset = pd.read_feather(shiny_data_file("ShinyApp_Data.feather"))
 # Simplify job types for nicer grouping
 dataset = dataset.copy()
 
-# Define a mapping for job type simplification based on prefixes
-job_type_mapping = {
-    "1-p": "1-P",  # Map job types starting with "1-p" to "1-P"
-    "GPU": "GPU", 
-    "MPI": "MPI",  
-    "OMP": "OMP"  
-}
-
-# Apply the mapping using a lambda function
-dataset["job_type"] = dataset["job_type"].apply(
-    lambda x: next((v for k, v in job_type_mapping.items() if str(x).startswith(k)), x))
-
-# Handle empty strings
-dataset["job_type"] = dataset["job_type"].replace("", pd.NA)
+# The homepage compares job classes; "1-p" is shown as "1-P"
+dataset["job_type"] = dataset["job_class"].cat.rename_categories({"1-p": "1-P"})
 
 # Ensure 'year' is integer
 dataset["year"] = dataset["year"].astype(int)
@@ -368,7 +357,7 @@ def homepage_server(input, output, session, selected_year, selected_month):
 
         # Compute medians
         medians = (
-            df.groupby("job_type")["first_job_waiting_time"]
+            df.groupby("job_type", observed=True)["first_job_waiting_time"]
             .median()
             .reset_index()
         )
@@ -0,0 +1,77 @@
+import json
+import time
+import socket
+import datetime
+import resource
+from contextlib import contextmanager
+
+
+def peak_rss_mb():
+    # High-water mark of this process's resident memory; ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageMetrics:
+    """
+    Wall time, rows in/out and peak RSS of each pipeline stage. A stage that
+    runs once per batch is summed over the batches, and write() appends one
+    JSON line per stage (plus a 'total' line) to metrics_file_name, tagged
+    with the keyword arguments given here (e.g. year=2025).
+    process_peak_rss_mb is the high-water mark of the process that ran the
+    stage, when the stage last finished: it includes the earlier stages, so
+    it is not the stage's own peak. Stages run by worker processes (see
+    add) get the max over the workers.
+    """
+
+    def __init__(self, metrics_file_name=None, **context):
+        self.metrics_file_name = metrics_file_name
+        self.context = context
+        self.stages = {}
+        self.start_time = time.time()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        # Time the with-block; set record['rows_out'] inside it to count its output rows
+        record = {'rows_out': None}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self.add(name, time.perf_counter() - start, rows_in, record['rows_out'])
+
+    def add(self, name, seconds, rows_in=None, rows_out=None, process_peak_rss_mb=None):
+        # process_peak_rss_mb of a stage run by another process, e.g. from the stages of a worker's StageMetrics
+        stage = self.stages.setdefault(name, {'stage': name, 'calls': 0, 'seconds': 0.0,
+                                              'rows_in': None, 'rows_out': None, 'process_peak_rss_mb': 0.0})
+        stage['calls'] += 1
+        stage['seconds'] += seconds
+        if rows_in is not None:
+            stage['rows_in'] = (stage['rows_in'] or 0) + int(rows_in)
+        if rows_out is not None:
+            stage['rows_out'] = (stage['rows_out'] or 0) + int(rows_out)
+        peak = peak_rss_mb() if process_peak_rss_mb is None else process_peak_rss_mb
+        stage['process_peak_rss_mb'] = max(stage['process_peak_rss_mb'], round(peak, 1))
+
+    def records(self):
+        started = datetime.datetime.fromtimestamp(self.start_time).isoformat(timespec='seconds')
+        common = {'started': started, 'host': socket.gethostname(), **self.context}
+        total = {'stage': 'total', 'calls': 1, 'seconds': time.time() - self.start_time,
+                 'rows_in': None, 'rows_out': None, 'process_peak_rss_mb': round(peak_rss_mb(), 1)}
+        return [{**common, **stage, 'seconds': round(stage['seconds'], 3)}
+                for stage in list(self.stages.values()) + [total]]
+
+    def report(self):
+        print(f"{'Stage':<16} {'Seconds':>10} {'Rows in':>12} {'Rows out':>12} {'Process peak MB':>16}")
+        for record in self.records():
+            rows_in = '' if record['rows_in'] is None else record['rows_in']
+            rows_out = '' if record['rows_out'] is None else record['rows_out']
+            print(f"{record['stage']:<16} {record['seconds']:>10.2f} {rows_in:>12} {rows_out:>12} "
+                  f"{record['process_peak_rss_mb']:>16.1f}")
+
+    def write(self):
+        if not self.metrics_file_name:
+            return
+        # A few short lines appended in one write, so parallel workers can share a metrics file
+        with open(self.metrics_file_name, 'a') as metrics_file:
+            for record in self.records():
+                metrics_file.write(json.dumps(record) + '\n')
@@ -5,10 +5,15 @@ from shinywidgets import output_widget, render_plotly
 import plotly.express as px
 import plotly.graph_objects as go
 import datetime
+import os
+from helpers import current_snapshot_dir, rollup_stats, rollup_view, queue_filter_mask, ROLLUP_FILE
 
 # DATA LOADING & PREP
 now = datetime.datetime.now()
-dataset = pd.read_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_MPI.feather")
+# The rows and the rollup (per month and per day stats) of the same snapshot
+data_dir = current_snapshot_dir()
+dataset = pd.read_feather(os.path.join(data_dir, "ShinyApp_Data_MPI.feather"))
+rollup = pd.read_feather(os.path.join(data_dir, ROLLUP_FILE))
 
 # Ensure 'year' is integer
 dataset["year"] = dataset["year"].astype(int)
@@ -181,43 +186,46 @@ def mpi_job_ui(selected_year, selected_month):
 def mpi_job_server(input, output, session, selected_year, selected_month):
     print("MPI Job server function called")
 
-    # 1) Reactive data filter by selected years (and possibly more in future)
+    # The year, month, job class and queue filter of the page; None until a valid year and month are picked.
+    # The stats look it up in the rollup instead of filtering the rows
     @reactive.calc
-    def dataset_data():
+    def selection():
         try:
             year = int(input.selected_year_mpi())
         except ValueError:
-            return dataset.iloc[0:0]
+            return None
 
         month = input.selected_month_mpi().capitalize()
         if month not in month_order:
-            return dataset.iloc[0:0]
-
-        df = dataset[(dataset["year"] == year) & (dataset["month"] == month)]
+            return None
 
-        queue_filter = input.queue_filter_mpi()
-        if queue_filter == "shared":
-            df = df[df["class_own"] == "shared"]
-        elif queue_filter == "buyin":
-            df = df[(df["class_own"] == "buyin") & (df["class_user"] == "buyin")]
+        return year, month, "MPI", input.queue_filter_mpi()
 
-        return df
+    # 1) Reactive data filter: the rows of the selection
+    @reactive.calc
+    def dataset_data():
+        s = selection()
+        if s is None:
+            return dataset.iloc[0:0]
 
+        year, month, _, queue_filter = s
+        df = dataset[(dataset["year"] == year) & (dataset["month"] == month)]
+        return df[queue_filter_mask(df, queue_filter)]
 
     # SUMMARY STATS (MIN, MAX, MEAN, MEDIAN, COUNT)
     @reactive.calc
     def stats():
-        df = dataset_data()
-        if df.empty:
+        s = selection()
+        s = rollup_stats(rollup, *s) if s is not None else {"count": 0}
+        if s["count"] == 0:
             return {"min": None, "max": None, "mean": None, "median": None, "count": 0}
 
-        waiting_sec = df["first_job_waiting_time"]
         return {
-            "min": max(waiting_sec.min() / 60.0, 0),
-            "max": waiting_sec.max() / 60.0,
-            "mean": waiting_sec.mean() / 60.0,
-            "median": waiting_sec.median() / 60.0,
-            "count": df.shape[0],
+            "min": max(s["min"] / 60.0, 0),
+            "max": s["max"] / 60.0,
+            "mean": s["mean"] / 60.0,
+            "median": s["median"] / 60.0,
+            "count": s["count"],
         }
 
     @output(id=f"{PAGE_ID}_min_waiting_time")
@@ -283,25 +291,27 @@ def mpi_job_server(input, output, session, selected_year, selected_month):
 
         df_plot = df.copy()
 
-        # Remove "MPI job " prefix
-        df_plot["job_type"] = df_plot["job_type"].str.replace("MPI job ", "", regex=False)
+        # The queue of each job (its job type label without the "MPI job" prefix)
+        df_plot["job_type"] = df_plot["qname"]
 
         # Convert to minutes and filter invalid times
         df_plot["first_job_waiting_time"] = df_plot["first_job_waiting_time"] / 60  # Convert to minutes
         df_plot = df_plot[df_plot["first_job_waiting_time"] >= 0]
 
         # Compute median waiting time per job_type
-        medians = df_plot.groupby("job_type")["first_job_waiting_time"].median().reset_index()
+        medians = df_plot.groupby("job_type", observed=True)["first_job_waiting_time"].median().reset_index()
 
         # Get top 6 job_types with largest medians
         top6 = medians.nlargest(6, "first_job_waiting_time")["job_type"].tolist()
 
         # Reassign job types into top 6 or 'others'
-        df_plot["job_type_grouped"] = df_plot["job_type"].apply(lambda x: x if x in top6 else "others")
+        df_plot["job_type_grouped"] = (
+            df_plot["job_type"].cat.set_categories(top6).cat.add_categories("others").fillna("others")
+        )
 
         # Recalculate median on grouped data
         grouped = (
-            df_plot.groupby("job_type_grouped")["first_job_waiting_time"]
+            df_plot.groupby("job_type_grouped", observed=True)["first_job_waiting_time"]
             .median()
             .reset_index()
             .sort_values("first_job_waiting_time", ascending=True)
@@ -354,25 +364,16 @@ def mpi_job_server(input, output, session, selected_year, selected_month):
     def mpi_job_waiting_time_by_day():
         if "selected_navset_bar" in input and input.selected_navset_bar() != "MPI Job":
             return None
-        df = dataset_data()
-        if df.empty or "day" not in df.columns:
+        s = selection()
+        daily = rollup_view(rollup, *s, by=["day"]) if s is not None else rollup.iloc[0:0]
+        if daily.empty:
             return go.Figure()
 
-        df_plot = df.copy()
-        df_plot["day"] = pd.to_numeric(df_plot["day"], errors="coerce")
-        df_plot = df_plot.dropna(subset=["day"])
-        df_plot["day"] = df_plot["day"].astype(int)
-
-        # Convert sec -> minutes
-        df_plot["job_waiting_time (minutes)"] = df_plot["first_job_waiting_time"] / 60.0
-
-        # Aggregate by day
-        daily_median = (
-            df_plot.groupby("day")["job_waiting_time (minutes)"]
-            .median()
-            .reset_index()
-            .sort_values("day")
-        )
+        # Median of each day, from the rollup; convert sec -> minutes
+        daily_median = pd.DataFrame({
+            "day": daily.index.astype(int),
+            "job_waiting_time (minutes)": daily["median"].to_numpy() / 60.0,
+        })
 
         # Get current month/year for title
         try:
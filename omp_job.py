@@ -6,14 +6,16 @@ import plotly.express as px
 import plotly.graph_objects as go
 from sklearn.cluster import KMeans
 import datetime
+from helpers import shiny_data_file, ARRAY_DTYPES
 
 
 # Load data from Feather
-dataset = pd.read_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_OMP.feather")
+dataset = pd.read_feather(shiny_data_file("ShinyApp_Data_OMP.feather"))
 now = datetime.datetime.now()
 
 # Drop rows with any NaN values (if desired, specify subset= for selective dropping)
-dataset.dropna(inplace=True)
+# gpu_bucket is only set for GPU jobs, and the array columns only exist when a year collapsed its array jobs
+dataset.dropna(subset=dataset.columns.drop(["gpu_bucket", *ARRAY_DTYPES], errors="ignore"), inplace=True)
 
 # Convert 'year' column to integer type
 dataset['year'] = dataset['year'].astype(int)
@@ -29,8 +31,9 @@ dataset["month"] = pd.Categorical(
     ordered=True
 )
 
-# Identify the CPU cores (slots) used by OMP jobs
-cpus = sorted(dataset[dataset.job_type == 'omp'].slots.unique().tolist())
+# Identify the CPU cores (slots) used by OMP jobs. This used to compare the old job_type label to 'omp', which
+# never matched, so the "other" bin stayed empty and jobs above 36 cores were never shown on this page
+cpus = sorted(dataset[dataset.job_class == 'OMP'].slots.unique().tolist())
 
 # Define CPU ranges (groupings)
 cpu_ranges = {
@@ -353,24 +356,26 @@ def omp_job_server(input, output, session, selected_year, selected_month):
 
         df_plot = data.copy()
 
-        # Clean job_type name
-        df_plot["job_type"] = df_plot["job_type"].str.replace("OMP ", "", regex=False)
+        # The queue of each job (its job type label without the "OMP" prefix)
+        df_plot["job_type"] = df_plot["qname"]
 
         # Convert to minutes
         df_plot["waiting_time_min"] = df_plot["first_job_waiting_time"] / 60
 
         # Compute median waiting time per job_type
-        medians = df_plot.groupby("job_type")["waiting_time_min"].median().reset_index()
+        medians = df_plot.groupby("job_type", observed=True)["waiting_time_min"].median().reset_index()
 
         # Identify top 6 job types with highest median
         top6 = medians.nlargest(6, "waiting_time_min")["job_type"].tolist()
 
         # Group others under "others"
-        df_plot["job_type_grouped"] = df_plot["job_type"].apply(lambda x: x if x in top6 else "others")
+        df_plot["job_type_grouped"] = (
+            df_plot["job_type"].cat.set_categories(top6).cat.add_categories("others").fillna("others")
+        )
 
         # Recalculate medians with grouped data
         grouped = (
-            df_plot.groupby("job_type_grouped")["waiting_time_min"]
+            df_plot.groupby("job_type_grouped", observed=True)["waiting_time_min"]
             .median()
             .reset_index()
             .sort_values(by="waiting_time_min", ascending=True)
@@ -525,17 +530,6 @@ def omp_job_server(input, output, session, selected_year, selected_month):
 
 
 
-    @reactive.effect
-    @reactive.event(input.select_all)
-    def _():
-        omp_jobs = [job for job in dataset.job_type.unique() if "OMP" in job]
-        ui.update_checkbox_group("job_type", selected=omp_jobs)
-
-    @reactive.effect
-    @reactive.event(input.unselect_all)
-    def _():
-        ui.update_checkbox_group("job_type", selected=[])
-
     @reactive.effect
     @reactive.event(input.cpus)
     def _():
@@ -5,14 +5,16 @@ from shinywidgets import output_widget, render_plotly
 import plotly.express as px
 import plotly.graph_objects as go
 import datetime
+from helpers import shiny_data_file, ARRAY_DTYPES
 
 # DATA LOADING
-dataset = pd.read_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_OneP.feather")
+dataset = pd.read_feather(shiny_data_file("ShinyApp_Data_OneP.feather"))
 now = datetime.datetime.now()
 
 # Ensure 'year' is integer
 # Optional: Remove rows with NaN values if needed
-dataset.dropna(inplace=True)
+# gpu_bucket is only set for GPU jobs, and the array columns only exist when a year collapsed its array jobs
+dataset.dropna(subset=dataset.columns.drop(["gpu_bucket", *ARRAY_DTYPES], errors="ignore"), inplace=True)
 dataset['year'] = dataset['year'].astype(int)
 
 # Set month order
@@ -243,24 +245,26 @@ def oneP_job_server(input, output, session, selected_year, selected_month):
 
         df_plot = df.copy()
 
-        # Clean job_type name
-        df_plot["job_type"] = df_plot["job_type"].str.replace("1-p ", "", regex=False)
+        # The queue of each job (its job type label without the "1-p" prefix)
+        df_plot["job_type"] = df_plot["qname"]
 
         # Convert to minutes
         df_plot["waiting_time_min"] = df_plot["first_job_waiting_time"] / 60
 
         # Compute median waiting time per job_type
-        medians = df_plot.groupby("job_type")["waiting_time_min"].median().reset_index()
+        medians = df_plot.groupby("job_type", observed=True)["waiting_time_min"].median().reset_index()
 
         # Identify top 6 job types with highest median
         top6 = medians.nlargest(6, "waiting_time_min")["job_type"].tolist()
 
         # Group others under "others"
-        df_plot["job_type_grouped"] = df_plot["job_type"].apply(lambda x: x if x in top6 else "others")
+        df_plot["job_type_grouped"] = (
+            df_plot["job_type"].cat.set_categories(top6).cat.add_categories("others").fillna("others")
+        )
 
         # Recalculate medians with grouped data
         grouped = (
-            df_plot.groupby("job_type_grouped")["waiting_time_min"]
+            df_plot.groupby("job_type_grouped", observed=True)["waiting_time_min"]
             .median()
             .reset_index()
             .sort_values(by="waiting_time_min", ascending=True)
@@ -1,75 +1,263 @@
 import pandas as pd
+import numpy as np
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import os  
+import json
 import time  
+import shutil
+import hashlib
+from helpers import (read_waiting_times, with_array_columns, queue_filter_mask, earlier_years_file, OUTPUT_DTYPES,
+                     SHINY_DATA_DIR, SNAPSHOT_DIR, DATASET_DIR, QUEUE_FILTERS, ROLLUP_KEYS, ROLLUP_LEVELS, ROLLUP_DTYPES,
+                     ROLLUP_FILE)
+from sketches import sketch_waiting_times, SKETCH_FILE
+
+OUTPUT_DIR = SHINY_DATA_DIR
+# Every year's consolidated rows as typed Feather, and the inputs they were read from
+CACHE_DIR = os.path.join(OUTPUT_DIR, "consolidation_cache")
+MANIFEST_FILE = os.path.join(CACHE_DIR, "manifest.json")
+CACHE_VERSION = 1  # bump when the cached rows change for the same inputs (e.g. new columns)
+
+def output_file(year):
+    # The output GetQueueTime wrote for year: the dataset, a typed Feather file or the CSV
+    if os.path.isdir(os.path.join(DATASET_DIR, f"year={year}")):  # written by GetQueueTime.py --dataset
+        return DATASET_DIR
+    file_path = f"{OUTPUT_DIR}/waiting_times_{year}_per_job_type.csv"
+    if os.path.exists(file_path.replace(".csv", ".feather")):  # typed output, e.g. from run_years.py --output *.feather
+        file_path = file_path.replace(".csv", ".feather")
+    return file_path
+
+def input_files(year):
+    """
+    The files year is read from: its output (a dataset partition, a typed Feather file or the CSV), and the
+    first jobs of earlier years the run of the next year found in its accounting file, if there are any.
+    """
+    file_path = output_file(year)
+    if file_path == DATASET_DIR:
+        partition = os.path.join(DATASET_DIR, f"year={year}")
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(partition) for name in names)
+    else:
+        paths = [file_path] if os.path.exists(file_path) else []
+    earlier_path = earlier_years_file(output_file(year + 1), year + 1)
+    return file_path, paths, earlier_path if os.path.exists(earlier_path) else None
+
+def read_year(file_path, earlier_path, year):
+    # The rows of year: its output, plus its jobs among the first jobs of earlier years of the next year's run
+    df = read_waiting_times(file_path, year) if file_path == DATASET_DIR else read_waiting_times(file_path)
+    if earlier_path:
+        earlier = read_waiting_times(earlier_path)
+        df, dtypes = with_array_columns(pd.concat([df, earlier[earlier["year"] == year]], ignore_index=True),
+                                        OUTPUT_DTYPES)
+        df = df.astype(dtypes)
+    return df
+
+def file_stats(paths):
+    return [[path, os.stat(path).st_size, os.stat(path).st_mtime_ns] for path in paths]
+
+def files_hash(paths):
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(path.encode())
+        with open(path, "rb") as input_file:
+            for chunk in iter(lambda: input_file.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def write_json(path, data):
+    with open(path, "w") as json_file:
+        json.dump(data, json_file, indent=1)
+
+def load_years(years):
+    """
+    Load every year's waiting times, re-reading only the years whose input
+    files changed since the last run. Files with the same sizes and mtimes
+    as in the manifest are trusted as they are; otherwise they are hashed,
+    and only a changed hash re-reads the year into its cache file.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    manifest = {}
+    if os.path.exists(MANIFEST_FILE):
+        with open(MANIFEST_FILE) as manifest_file:
+            manifest = json.load(manifest_file)
+    if manifest.get("version") != CACHE_VERSION:
+        manifest = {"version": CACHE_VERSION, "years": {}}
+
+    dataframes, reread = [], []
+    for year in years:
+        file_path, paths, earlier_path = input_files(year)
+        cache_file = os.path.join(CACHE_DIR, f"{year}.feather")
+        if not paths:
+            print(f"File not found: {file_path}")
+            manifest["years"].pop(str(year), None)
+            continue
+        paths = paths + ([earlier_path] if earlier_path else [])
+        stats, entry = file_stats(paths), manifest["years"].get(str(year))
+        if entry and entry["files"] == stats and os.path.exists(cache_file):
+            dataframes.append(pd.read_feather(cache_file))
+            continue
+        files_sha256 = files_hash(paths)
+        if entry and entry["sha256"] == files_sha256 and os.path.exists(cache_file):  # touched, not changed
+            df = pd.read_feather(cache_file)
+        else:
+            df = read_year(file_path, earlier_path, year)
+            df.to_feather(cache_file + ".tmp")
+            os.replace(cache_file + ".tmp", cache_file)
+            reread.append(year)
+        manifest["years"][str(year)] = {"files": stats, "sha256": files_sha256}
+        dataframes.append(df)
+
+    write_json(MANIFEST_FILE + ".tmp", manifest)
+    os.replace(MANIFEST_FILE + ".tmp", MANIFEST_FILE)
+    print(f"Re-read {len(reread)} of {len(dataframes)} years: {reread}")
+    return dataframes
 
 # Start the timer
 start_time = time.time()
 
 current_year = datetime.now().year
 
-dataframes = []
-# Automatically process all year CSV files into feather format
-for year in range(2013, current_year + 1):
-    file_path = f"/projectnb/rcs-intern/Jiazheng/accounting/waiting_times_{year}_per_job_type.csv"
-    if os.path.exists(file_path):
-        df = pd.read_csv(file_path)
-        dataframes.append(df)
-    else:
-        print(f"File not found: {file_path}")
+# Automatically process all year CSV files into feather format, reusing the years that did not change
+dataframes = load_years(range(2013, current_year + 1))
 
-dataset = pd.concat(dataframes, ignore_index=True)
+# Years have different label categories, so restore the schema after concatenating; years written without
+# --collapse-arrays have no array columns, so their rows are filled in as single tasks
+dataset, dtypes = with_array_columns(pd.concat(dataframes, ignore_index=True), OUTPUT_DTYPES)
+dataset = dataset.astype(dtypes)
 
 # Remove 'buyin' rows
 # dataset = dataset[dataset["queue_type"] != "buyin"].reset_index(drop=True)
 
-# Basic cleaning/conversions here so we don’t do them repeatedly:
-dataset["year"] = dataset["year"].astype(int, errors="ignore")
-
-month_order = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", 
-               "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
-if "month" in dataset.columns:
-    dataset["month"] = pd.Categorical(dataset["month"], categories=month_order, ordered=True)
+# year and month already come typed (uint16, ordered month categorical) from read_waiting_times
 
 # Drop rows with NA if needed
 dataset = dataset[dataset["first_job_waiting_time"] >= 0] # drop negative value in case!
-dataset.dropna(subset=["year", "job_type", "first_job_waiting_time"], inplace=True)
-
-# Define filter functions
-def filter_data_by_job_type(job_type_pattern, years=None):
-    """Generic function to filter dataset by job type and years."""
-    df = dataset[dataset["job_type"].str.startswith(job_type_pattern, na=False)].copy()
-    if years:
-        df = df[df["year"].isin(years)]
-    return df
+dataset.dropna(subset=["year", "job_class", "first_job_waiting_time"], inplace=True)
+
+# ShinyApp file of each job class
+JOB_CLASS_FILES = {"GPU": "GPU", "MPI": "MPI", "OMP": "OMP", "1-p": "OneP"}
+KEEP_SNAPSHOTS = 3  # older snapshots are removed; the app reads the live one, or one it resolved shortly before
+
+# Split the dataset by job class in one pass
+def split_by_job_class(df, years=None):
+    """
+    Split df into one DataFrame per job class (GPU, MPI, OMP or 1-p), restricted to years.
+    The rows are grouped with a single stable sort of the job_class codes, so together the
+    parts are one copy of df, each in the original row order.
+    """
+    keep = df["year"].isin(years).to_numpy() if years else np.ones(len(df), dtype=bool)
+    codes = df["job_class"].cat.codes.to_numpy()
+    rows = np.flatnonzero(keep & (codes >= 0))
+    rows = rows[np.argsort(codes[rows], kind="stable")]
+    bounds = np.searchsorted(codes[rows], np.arange(len(df["job_class"].cat.categories) + 1))
+    parts = {}
+    for i, job_class in enumerate(df["job_class"].cat.categories):
+        part = df.take(rows[bounds[i]:bounds[i + 1]])
+        part.index = pd.RangeIndex(len(part))
+        # Queues of the other job classes would otherwise stay in the categories of the saved file;
+        # job_class and gpu_bucket keep their fixed categories
+        for column in ["qname", "class_user", "class_own"]:
+            part[column] = part[column].cat.remove_unused_categories()
+        parts[job_class] = part
+    return parts
+
+def rollup_waiting_times(df):
+    """
+    Aggregate df into the rollup the pages and queue-info.py read (see
+    ROLLUP_DTYPES): for every queue filter, the count, sum, sum of squares,
+    min, max and median of the waits per (year, month, job_class) and per
+    day, qname and (day, qname) within those.
+    """
+    wait = df["first_job_waiting_time"].astype("int64")
+    df = df[["year", "month", "job_class", "day", "qname", "class_user", "class_own"]].assign(
+        wait=wait, wait_sq=wait.astype("float64") ** 2)
+    parts = []
+    for queue_filter in QUEUE_FILTERS:
+        rows = df[queue_filter_mask(df, queue_filter)]
+        for level in ROLLUP_LEVELS:
+            grouped = rows.groupby(["year", "month", "job_class", *level], observed=True)
+            part = grouped["wait"].agg(["count", "sum", "min", "max", "median"])
+            part["sum_sq"] = grouped["wait_sq"].sum()
+            part = part.reset_index().assign(queue_filter=queue_filter)
+            if "day" not in level:
+                part["day"] = 0
+            if "qname" not in level:
+                part["qname"] = pd.Categorical([None] * len(part), dtype=df["qname"].dtype)
+            parts.append(part)
+    rollup = pd.concat(parts, ignore_index=True)
+    rollup = rollup[list(ROLLUP_DTYPES)].astype(ROLLUP_DTYPES)
+    return rollup.sort_values(ROLLUP_KEYS, ignore_index=True)
+
+def write_feather_and_csv(df, file_name):
+    # file_name without extension; both files are flushed to disk before the snapshot is published
+    for path in [f"{file_name}.feather", f"{file_name}.csv"]:
+        df.to_feather(path) if path.endswith(".feather") else df.to_csv(path, index=False)
+        fsync(path)
+
+def fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def replace_file(path, write):
+    # Write path through write(tmp_path) and rename it into place: readers see the old file or the new one
+    write(path + ".tmp")
+    fsync(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def link_file(source, path):
+    # A hard link shares the snapshot's data, so the flat files cost no extra space
+    if os.path.lexists(path):
+        os.remove(path)  # left by a run that was killed
+    os.link(source, path)
+
+def publish_snapshot(outputs, workers, keep=KEEP_SNAPSHOTS):
+    """
+    Write outputs ([(DataFrame, name)]) as a new snapshot directory under
+    SNAPSHOT_DIR and make it the live one. The files are written to a hidden
+    staging directory that is renamed into place once they are all on disk,
+    then current.json is replaced to point at it; a reader that resolved the
+    previous snapshot keeps reading it. The flat files in OUTPUT_DIR that
+    other scripts read are swapped for hard links to the new snapshot, and
+    all but the last keep snapshots are removed. Returns the version.
+    """
+    version = datetime.now().strftime("%Y%m%d-%H%M%S-") + str(os.getpid())
+    staging_dir = os.path.join(SNAPSHOT_DIR, f".{version}.tmp")
+    snapshot_dir = os.path.join(SNAPSHOT_DIR, version)
+    os.makedirs(staging_dir)
+    # Arrow releases the GIL while it writes, so the files are written concurrently
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(write_feather_and_csv, df, os.path.join(staging_dir, name))
+                       for df, name in outputs]:
+            future.result()
+    fsync(staging_dir)
+    os.rename(staging_dir, snapshot_dir)
+    fsync(SNAPSHOT_DIR)
+
+    files = sorted(os.listdir(snapshot_dir))
+    pointer = {"version": version, "files": files, "published": datetime.now().isoformat(timespec="seconds")}
+    replace_file(os.path.join(SNAPSHOT_DIR, "current.json"), lambda path: write_json(path, pointer))
+    for name in files:
+        replace_file(os.path.join(OUTPUT_DIR, name), lambda path: link_file(os.path.join(snapshot_dir, name), path))
+
+    versions = sorted(name for name in os.listdir(SNAPSHOT_DIR) if not name.startswith(".") and name != "current.json")
+    for old_version in versions[:-keep]:
+        shutil.rmtree(os.path.join(SNAPSHOT_DIR, old_version))
+    return version
+
+# Save each job class, and the fully cleaned dataset, as a Feather and a CSV file
+def save_filtered_data(workers=len(JOB_CLASS_FILES) + 1):
+    years = list(range(2013, current_year + 1))
+    parts = split_by_job_class(dataset, years)
 
-# Save each filtered dataset as a Feather and CSV file
-def save_filtered_data():
-    years = list(range(2013, current_year + 1))  
-
-    # GPU jobs
-    gpu_df = filter_data_by_job_type("GPU", years)
-    gpu_df.reset_index(drop=True).to_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_GPU.feather")
-    gpu_df.to_csv("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_GPU.csv", index=False)
-
-    # MPI jobs
-    mpi_df = filter_data_by_job_type("MPI", years)
-    mpi_df.reset_index(drop=True).to_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_MPI.feather")
-    mpi_df.to_csv("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_MPI.csv", index=False)
-
-    # OMP jobs
-    omp_df = filter_data_by_job_type("OMP", years)
-    omp_df.reset_index(drop=True).to_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_OMP.feather")
-    omp_df.to_csv("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_OMP.csv", index=False)
-
-    # 1-p jobs
-    onep_df = filter_data_by_job_type("1-p", years)
-    onep_df.reset_index(drop=True).to_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_OneP.feather")
-    onep_df.to_csv("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data_OneP.csv", index=False)
-
-    # Save the fully cleaned dataset
-    dataset.reset_index(drop=True).to_feather("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data.feather")
-    dataset.to_csv("/projectnb/rcs-intern/Jiazheng/accounting/ShinyApp_Data.csv", index=False)
+    dataset.reset_index(drop=True, inplace=True)
+    outputs = [(parts[job_class], f"ShinyApp_Data_{name}") for job_class, name in JOB_CLASS_FILES.items()]
+    outputs.append((dataset, "ShinyApp_Data"))
+    outputs.append((rollup_waiting_times(dataset), ROLLUP_FILE.removesuffix(".feather")))
+    outputs.append((sketch_waiting_times(dataset), SKETCH_FILE.removesuffix(".feather")))
+    version = publish_snapshot(outputs, workers)
+    print(f"Published snapshot {version} in {SNAPSHOT_DIR}")
 
 # Usage
 if __name__ == "__main__":
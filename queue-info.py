@@ -2,6 +2,7 @@
 import sys
 import pandas as pd
 from pathlib import Path
+from helpers import current_snapshot_dir, rollup_stats, ROLLUP_FILE
 
 # Helper function to format time
 def format_time(seconds):
@@ -20,9 +21,14 @@ if len(sys.argv) != 3:
 year = int(sys.argv[1])
 month = int(sys.argv[2])
 
-# Define the path to the Feather files
-base_path = Path("/projectnb/rcs-intern/Jiazheng/accounting")
-job_types = ["GPU", "MPI", "OMP", "OneP"]
+# The pre-aggregated waiting times of the live snapshot: a few rows per month instead of every job
+base_path = Path(current_snapshot_dir())
+job_types = {"GPU": "GPU", "MPI": "MPI", "OMP": "OMP", "OneP": "1-p"}  # job type shown -> job_class
+try:
+    rollup = pd.read_feather(base_path / ROLLUP_FILE)
+except FileNotFoundError:
+    print(f"File not found: {base_path / ROLLUP_FILE}")
+    sys.exit(1)
 
 # Map month number to month abbreviation (e.g., 4 -> "Apr")
 month_abbr = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", 
@@ -37,29 +43,18 @@ print(f"{'Job Type':<10} {'Min':<15} {'Max':<15} {'Mean':<15} {'Median':<15} {'F
 print("-" * 95)
 
 # Process each job type
-for job_type in job_types:
-    file_path = base_path / f"ShinyApp_Data_{job_type}.feather"
-    
-    # Read the Feather file
-    try:
-        df = pd.read_feather(file_path)
-    except FileNotFoundError:
-        print(f"File not found: {file_path}")
-        continue
-
-    # Filter rows by year and month
-    filtered_df = df[(df["year"] == year) & (df["month"] == month_name)]
+for job_type, job_class in job_types.items():
+    stats = rollup_stats(rollup, year, month_name, job_class)
 
     # Calculate statistics
-    if not filtered_df.empty:
-        waiting_times = filtered_df["first_job_waiting_time"]
-        min_val = format_time(waiting_times.min())
-        max_val = format_time(waiting_times.max())
-        mean_val = format_time(waiting_times.mean())
-        median_val = format_time(waiting_times.median())
-        total_jobs = len(waiting_times)
+    if stats["count"]:
+        min_val = format_time(stats["min"])
+        max_val = format_time(stats["max"])
+        mean_val = format_time(stats["mean"])
+        median_val = format_time(stats["median"])
+        total_jobs = stats["count"]
 
         # Print results in a horizontal table format
         print(f"{job_type:<10} {min_val:<15} {max_val:<15} {mean_val:<15} {median_val:<15} {total_jobs:<10}")
     else:
-        print(f"{job_type:<10} {'No data found':<70}")
\ No newline at end of file
+        print(f"{job_type:<10} {'No data found':<70}")
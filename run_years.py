@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Run GetQueueTime for a range of years in parallel, one year per worker process
+import os
+import time
+import argparse
+import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from metrics import StageMetrics
+from GetQueueTime import (waiting_time_per_job_type, extra_output_files, INPUT_FILE_TEMPLATE, OUTPUT_FILE_TEMPLATE,
+                          STATE_FILE_TEMPLATE, EXTRA_OUTPUT_TEMPLATES, default_workers)
+
+
+def process_year(year, input_template, output_template, state_template=None, batch_rows=None, metrics_file_name=None,
+                 extra_outputs=()):
+    input_file_name = input_template.format(year=year)
+    output_file_name = output_template.format(year=year)
+    state_file_name = state_template.format(year=year) if state_template else None
+    if state_file_name and os.path.exists(state_file_name):
+        os.remove(state_file_name)  # a backfill rebuilds the year instead of resuming it
+
+    start_time = time.time()
+    metrics = StageMetrics(metrics_file_name, script='run_years', year=year, batch_rows=batch_rows)
+    waiting_time_per_job_type(input_file_name, output_file_name, year, state_file_name, batch_rows=batch_rows,
+                              metrics=metrics, extra_outputs=extra_output_files(extra_outputs, year),
+                              previous_input_file_name=input_template.format(year=year - 1))
+    return output_file_name, time.time() - start_time
+
+
+def run_years(years, workers, input_template=INPUT_FILE_TEMPLATE, output_template=OUTPUT_FILE_TEMPLATE,
+              state_template=None, batch_rows=None, metrics_file_name=None, extra_outputs=()):
+    """
+    Process each year in its own worker process. Every year reads its own
+    accounting file and writes its own output, so a failing year is reported
+    without stopping the others. Returns {year: running time in seconds}.
+
+    Every year is independent: jobs that ran over new year's are in the file
+    of the year they ended in, and a year only reads the file of the year
+    before for the end times its jobs of earlier years start from (see
+    GetQueueTime.waiting_time_per_job_type). With
+    state_template, every year also saves its state, so incremental runs of
+    the current year continue from the backfill. batch_rows streams every
+    year in bounded batches, so memory per worker stays fixed.
+    metrics_file_name collects every year's StageMetrics. extra_outputs
+    names the GetQueueTime extra outputs every year writes as well.
+    """
+    timings = {}
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_year, year, input_template, output_template, state_template, batch_rows,
+                                   metrics_file_name, extra_outputs): year for year in years}
+        for future in as_completed(futures):
+            year = futures[future]
+            try:
+                output_file_name, running_time = future.result()
+            except Exception as exc:
+                failed.append(year)
+                print(f"{year}: failed ({exc!r})")
+                continue
+            timings[year] = running_time
+            print(f"{year}: saved to {output_file_name} in {running_time:.1f} seconds")
+
+    if failed:
+        raise SystemExit(f"Failed years: {sorted(failed)}")
+    return timings
+
+
+if __name__ == "__main__":
+    current_year = datetime.datetime.now().year
+    parser = argparse.ArgumentParser(description='Process accounting data for several years in parallel.')
+    parser.add_argument('first_year', type=int, nargs='?', default=2013, help='First year to process (default: 2013)')
+    parser.add_argument('last_year', type=int, nargs='?', default=current_year, help='Last year to process (default: current year)')
+    parser.add_argument('--workers', type=int, default=default_workers(),
+                        help='Number of worker processes (default: $NSLOTS or the number of cores)')
+    parser.add_argument('--input', default=INPUT_FILE_TEMPLATE, help='Input path template with a {year} field')
+    parser.add_argument('--output', default=OUTPUT_FILE_TEMPLATE, help='Output path template with a {year} field')
+    parser.add_argument('--state', default=STATE_FILE_TEMPLATE,
+                        help='State path template with a {year} field; every year saves its state there, so '
+                             'incremental runs continue from the backfill')
+    parser.add_argument('--batch-rows', type=int, default=None,
+                        help='Stream each year in batches of about this many rows to bound memory per worker')
+    parser.add_argument('--metrics', default=None,
+                        help='Append per-stage timings, row counts and peak memory of every year to this JSON-lines file')
+    parser.add_argument('--extra-outputs', nargs='+', choices=list(EXTRA_OUTPUT_TEMPLATES), default=[],
+                        help='Also write these GetQueueTime outputs for every year (the summaries imply all_jobs)')
+    args = parser.parse_args()
+
+    years = list(range(args.first_year, args.last_year + 1))
+    start_time = time.time()
+    timings = run_years(years, args.workers, args.input, args.output, args.state, args.batch_rows, args.metrics,
+                        args.extra_outputs)
+    running_time = time.time() - start_time
+
+    print()
+    print(f"{'Year':<6} {'Seconds':>10}")
+    for year in sorted(timings):
+        print(f"{year:<6} {timings[year]:>10.1f}")
+    print(f"Processed {len(timings)} years with {args.workers} workers in {running_time:.1f} seconds "
+          f"(serial total {sum(timings.values()):.1f} seconds)")
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# Scatter/gather runs of GetQueueTime: one task per (year, owner shard), submitted as an SGE array job, then a merge task
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import subprocess
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from concurrent.futures import ProcessPoolExecutor
+from metrics import StageMetrics
+from helpers import read_accounting, earlier_years_file
+from GetQueueTime import (scan_owner_shard, merge_shard_results, owner_shards, merge_latest_end_times, load_state,
+                          save_state, write_output, is_dataset, remove_parts, output_size, write_arrow, read_arrow,
+                          previous_year_end_times, split_earlier_years, default_workers, INPUT_FILE_TEMPLATE,
+                          OUTPUT_FILE_TEMPLATE, STATE_FILE_TEMPLATE)
+
+QWT_DIR = os.path.dirname(os.path.abspath(__file__))
+WORK_DIR = '/projectnb/rcs-intern/Jiazheng/accounting/scatter'
+SCATTER_SCRIPT = os.path.join(QWT_DIR, 'scatterTask.qsub')
+GATHER_SCRIPT = os.path.join(QWT_DIR, 'gatherTask.qsub')
+
+
+def make_plan(years, shards, work_dir=WORK_DIR, input_template=INPUT_FILE_TEMPLATE,
+              output_template=OUTPUT_FILE_TEMPLATE, state_template=None, metrics_file_name=None):
+    """
+    Write the plan of a scatter/gather run to a new directory under work_dir:
+    one task per (year, owner shard), in the order of their SGE task ids.
+    Returns the plan file name.
+    """
+    run_dir = os.path.join(work_dir, datetime.datetime.now().strftime('%Y%m%d-%H%M%S-') + str(os.getpid()))
+    os.makedirs(run_dir)
+    plan = {
+        'run_dir': run_dir,
+        'years': sorted(years),
+        'shards': shards,
+        'tasks': [{'year': year, 'shard': shard} for year in sorted(years) for shard in range(shards)],
+        'input_template': input_template,
+        'output_template': output_template,
+        'state_template': state_template,
+        'metrics_file_name': metrics_file_name,
+    }
+    plan_file_name = os.path.join(run_dir, 'plan.json')
+    with open(plan_file_name, 'w') as plan_file:
+        json.dump(plan, plan_file, indent=1)
+    return plan_file_name
+
+
+def load_plan(plan_file_name):
+    with open(plan_file_name) as plan_file:
+        return json.load(plan_file)
+
+
+def part_file_name(plan, year, shard):
+    return os.path.join(plan['run_dir'], f'{year}_{shard}.arrow')
+
+
+def run_task(plan_file_name, task_id):
+    """
+    Scatter task task_id (1-based, like SGE_TASK_ID): scan the owners of one
+    shard of one year. Every task reads the whole year, so row numbers are the
+    same in all the shards, and saves its output rows and state to the run
+    directory for gather. Like GetQueueTime, the scan starts from the end
+    times of the year before (previous_year_end_times) of the shard's owners.
+    """
+    plan = load_plan(plan_file_name)
+    year, shard = plan['tasks'][task_id - 1]['year'], plan['tasks'][task_id - 1]['shard']
+    metrics = StageMetrics(plan['metrics_file_name'], script='scatter', year=year, shard=shard, shards=plan['shards'])
+    with metrics.stage('read') as stage:
+        table = read_accounting(plan['input_template'].format(year=year), as_table=True)
+        watermark = pc.max(table['ux_end_time']).as_py() or 0
+        table = table.append_column('row', pa.array(np.arange(table.num_rows)))
+        if plan['shards'] > 1:
+            in_shard = owner_shards(table['owner'].to_numpy(zero_copy_only=False), plan['shards']) == shard
+            table = table.filter(pa.array(in_shard))
+        df = table.to_pandas(split_blocks=True, self_destruct=True)
+        del table
+        df.index = df.pop('row')
+        stage['rows_out'] = len(df)
+
+    latest_end_times = None
+    previous_input_file_name = plan['input_template'].format(year=year - 1)
+    if os.path.exists(previous_input_file_name):
+        with metrics.stage('previous_year') as stage:
+            latest_end_times = previous_year_end_times(previous_input_file_name)
+            if plan['shards'] > 1:
+                latest_end_times = latest_end_times[owner_shards(latest_end_times['owner'], plan['shards']) == shard]
+            stage['rows_out'] = len(latest_end_times)
+
+    result, latest_end_times = scan_owner_shard(df, latest_end_times, metrics=metrics)
+    file_name = part_file_name(plan, year, shard)
+    write_arrow(result, file_name + '.tmp')
+    save_state(file_name + '.state', latest_end_times, watermark, 0)
+    os.replace(file_name + '.tmp', file_name)  # the part is there only once its state is
+    metrics.write()
+    print(f'{year} shard {shard}: {len(result)} first jobs')
+
+
+def gather(plan_file_name):
+    """
+    Merge task: put the shards of every year back together in the order of a
+    single scan (see merge_shard_results) and write the yearly outputs, with
+    the first jobs of earlier years in earlier_years_file, and states. The
+    run directory is removed once everything is written.
+    """
+    plan = load_plan(plan_file_name)
+    missing = [task for task in plan['tasks'] if not os.path.exists(part_file_name(plan, task['year'], task['shard']))]
+    if missing:
+        raise SystemExit(f"Missing scatter results, not merging: {missing}")
+
+    for year in plan['years']:
+        metrics = StageMetrics(plan['metrics_file_name'], script='gather', year=year, shards=plan['shards'])
+        file_names = [part_file_name(plan, year, shard) for shard in range(plan['shards'])]
+        with metrics.stage('merge') as stage:
+            rows = merge_shard_results([read_arrow(file_name).to_pandas() for file_name in file_names])
+            states = [load_state(file_name + '.state') for file_name in file_names]
+            stage['rows_out'] = len(rows)
+
+        output_file_name = plan['output_template'].format(year=year)
+        earlier_years_file_name = earlier_years_file(output_file_name, year)
+        earlier_rows, rows = split_earlier_years(rows, year)
+        with metrics.stage('write', rows_in=len(rows) + len(earlier_rows)) as stage:
+            if is_dataset(output_file_name):
+                remove_parts(output_file_name, year)
+            write_output(rows, output_file_name)
+            os.makedirs(os.path.dirname(earlier_years_file_name) or '.', exist_ok=True)
+            write_output(earlier_rows, earlier_years_file_name)
+            if plan['state_template']:
+                save_state(plan['state_template'].format(year=year),
+                           merge_latest_end_times(*[state[0] for state in states]),
+                           max(state[1] for state in states), output_size(output_file_name),
+                           earlier_years_size=output_size(earlier_years_file_name))
+            stage['rows_out'] = len(rows)
+        metrics.write()
+        print(f'{year}: {len(rows)} first jobs saved to {output_file_name}')
+
+    shutil.rmtree(plan['run_dir'])
+
+
+class LocalExecutor:
+    """
+    Runs the scatter tasks of a plan in a local process pool, then gather in
+    this process: the same tasks as SGEExecutor, without SGE.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or default_workers()
+
+    def submit(self, plan_file_name):
+        n_tasks = len(load_plan(plan_file_name)['tasks'])
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(run_task, [plan_file_name] * n_tasks, range(1, n_tasks + 1)))
+        gather(plan_file_name)
+
+
+class SGEExecutor:
+    """
+    Submits the scatter tasks of a plan as one SGE array job (scatterTask.qsub,
+    one task per SGE_TASK_ID) and gather as a job that holds until the whole
+    array is done (gatherTask.qsub). Returns without waiting for them.
+    """
+
+    def __init__(self, qsub_options=()):
+        self.qsub_options = list(qsub_options)
+
+    def qsub(self, *args):
+        output = subprocess.run(['qsub', '-terse'] + self.qsub_options + list(args),
+                                check=True, capture_output=True, text=True).stdout
+        return output.strip().split('.')[0]  # array jobs print "<job id>.1-N:1"
+
+    def submit(self, plan_file_name):
+        n_tasks = len(load_plan(plan_file_name)['tasks'])
+        scatter_job = self.qsub('-t', f'1-{n_tasks}', SCATTER_SCRIPT, plan_file_name)
+        gather_job = self.qsub('-hold_jid', scatter_job, GATHER_SCRIPT, plan_file_name)
+        print(f'Submitted {n_tasks} scatter tasks as job {scatter_job} and the merge as job {gather_job}')
+
+
+if __name__ == "__main__":
+    current_year = datetime.datetime.now().year
+    parser = argparse.ArgumentParser(description='Run GetQueueTime as scatter tasks per (year, owner shard) and a merge.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    submit_parser = subparsers.add_parser('submit', help='Plan a run and submit its tasks')
+    submit_parser.add_argument('first_year', type=int, nargs='?', default=current_year, help='First year to process')
+    submit_parser.add_argument('last_year', type=int, nargs='?', default=None, help='Last year (default: first_year)')
+    submit_parser.add_argument('--shards', type=int, default=1, help='Owner shards per year (one task each)')
+    submit_parser.add_argument('--executor', choices=['sge', 'local'], default='sge',
+                               help='Submit an SGE array job, or run the tasks in a local process pool')
+    submit_parser.add_argument('--workers', type=int, default=None, help='Worker processes of the local executor')
+    submit_parser.add_argument('--work-dir', default=WORK_DIR, help='Where the run directories are created')
+    submit_parser.add_argument('--input', default=INPUT_FILE_TEMPLATE, help='Input path template with a {year} field')
+    submit_parser.add_argument('--output', default=OUTPUT_FILE_TEMPLATE, help='Output path template with a {year} field')
+    submit_parser.add_argument('--state', default=STATE_FILE_TEMPLATE,
+                               help='State path template with a {year} field; the merge saves every year\'s state there')
+    submit_parser.add_argument('--metrics', default=None,
+                               help='Append per-stage metrics of every task to this JSON-lines file')
+
+    task_parser = subparsers.add_parser('task', help='Run one scatter task (SGE_TASK_ID by default)')
+    task_parser.add_argument('plan', help='plan.json of the run')
+    task_parser.add_argument('--task-id', type=int, default=None, help='1-based task number')
+
+    gather_parser = subparsers.add_parser('gather', help='Merge the results of all the scatter tasks')
+    gather_parser.add_argument('plan', help='plan.json of the run')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    if args.command == 'submit':
+        years = list(range(args.first_year, (args.last_year or args.first_year) + 1))
+        plan_file_name = make_plan(years, args.shards, args.work_dir, args.input, args.output, args.state,
+                                   args.metrics)
+        executor = LocalExecutor(args.workers) if args.executor == 'local' else SGEExecutor()
+        executor.submit(plan_file_name)
+    elif args.command == 'task':
+        task_id = args.task_id or int(os.environ.get('SGE_TASK_ID', 0))
+        if not task_id:
+            sys.exit('No task id: pass --task-id or run as an SGE array task')
+        run_task(args.plan, task_id)
+    else:
+        gather(args.plan)
+    print(f"Running time: {time.time() - start_time:.1f} seconds")
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import argparse
+import numpy as np
+import pandas as pd
+from helpers import MONTHS, JOB_TYPES, QUEUE_FILTERS, queue_filter_mask, current_snapshot_dir
+
+# Mergeable quantile sketches of the waiting times, one per (year, month, job_class, queue_filter, qname) cell,
+# written by process_waiting_times into every snapshot. A sketch counts the waits of its cell in log-spaced buckets
+# (as in DDSketch): bucket 0 holds the waits of 0 seconds and bucket k > 0 the waits in (GAMMA ** (k - 2),
+# GAMMA ** (k - 1)]. Summing the counts of any set of cells gives the sketch of their union exactly, and every
+# quantile read from it is within SKETCH_ALPHA (relative) of the exact one.
+
+SKETCH_ALPHA = 0.01
+GAMMA = (1 + SKETCH_ALPHA) / (1 - SKETCH_ALPHA)
+SKETCH_KEYS = ['year', 'month', 'job_class', 'queue_filter', 'qname']
+SKETCH_DTYPES = {
+    'year': 'uint16',
+    'month': pd.CategoricalDtype(MONTHS, ordered=True),
+    'job_class': pd.CategoricalDtype(JOB_TYPES),
+    'queue_filter': pd.CategoricalDtype(QUEUE_FILTERS),
+    'qname': 'category',
+    'bucket': 'int16',  # waits fit in int32, so there are at most ~1100 buckets
+    'count': 'int64',
+}
+SKETCH_FILE = 'ShinyApp_Sketch.feather'
+
+
+def sketch_buckets(waits):
+    # Bucket of every wait (seconds, >= 0)
+    waits = np.asarray(waits, dtype=np.float64)
+    buckets = np.zeros(len(waits), dtype=np.int16)
+    positive = waits > 0
+    buckets[positive] = np.ceil(np.log(waits[positive]) / np.log(GAMMA)).astype(np.int16) + 1
+    return buckets
+
+
+def bucket_values(buckets):
+    # The value every wait of a bucket is read as: within SKETCH_ALPHA of all of them
+    k = np.asarray(buckets, dtype=np.float64) - 1
+    return np.where(k >= 0, 2 * GAMMA ** k / (GAMMA + 1), 0.0)
+
+
+def sketch_waiting_times(df):
+    """
+    Sketch the waits of df (the ShinyApp data) per cell, for every queue
+    filter: one row per (cell, bucket) with the number of waits in it.
+    """
+    df = df[['year', 'month', 'job_class', 'qname', 'class_user', 'class_own']].assign(
+        bucket=sketch_buckets(df['first_job_waiting_time']))
+    parts = []
+    for queue_filter in QUEUE_FILTERS:
+        rows = df[queue_filter_mask(df, queue_filter)]
+        part = rows.groupby(['year', 'month', 'job_class', 'qname', 'bucket'], observed=True, dropna=False).size()
+        parts.append(part.rename('count').reset_index().assign(queue_filter=queue_filter))
+    sketch = pd.concat(parts, ignore_index=True)[list(SKETCH_DTYPES)].astype(SKETCH_DTYPES)
+    return sketch.sort_values([*SKETCH_KEYS, 'bucket'], ignore_index=True)
+
+
+def sketch_quantiles(counts, quantiles):
+    """
+    Quantiles (fractions in [0, 1]) of the waits counted in counts (waits per
+    bucket), interpolated between the two nearest waits like
+    pandas.Series.quantile; NaN for an empty sketch.
+    """
+    n = counts.sum()
+    if n == 0:
+        return np.full(len(quantiles), np.nan)
+    cumulative = np.cumsum(counts)
+    ranks = np.asarray(quantiles, dtype=np.float64) * (n - 1)
+    low = bucket_values(np.searchsorted(cumulative, np.floor(ranks), side='right'))
+    high = bucket_values(np.searchsorted(cumulative, np.ceil(ranks), side='right'))
+    return low + (ranks - np.floor(ranks)) * (high - low)
+
+
+class WaitSketches:
+    """
+    The sketches of a snapshot, laid out for queries: the cells in a small
+    table and the (bucket, count) rows of each cell one after the other, so a
+    query selects cells and sums their counts without touching the rest.
+    """
+
+    def __init__(self, sketch):
+        sketch = sketch.sort_values([*SKETCH_KEYS, 'bucket'], ignore_index=True)
+        cell = sketch.groupby(SKETCH_KEYS, observed=True, dropna=False, sort=False).ngroup().to_numpy()
+        starts = np.flatnonzero(np.r_[True, cell[1:] != cell[:-1]]) if len(sketch) else np.zeros(0, dtype=np.int64)
+        # Cells hold a code per key value, so a query selects them with a lookup table instead of comparing labels
+        self.cells, self.codes = {}, {}
+        for column in SKETCH_KEYS:
+            codes, values = pd.factorize(sketch[column].to_numpy()[starts], use_na_sentinel=False)
+            self.cells[column] = codes
+            self.codes[column] = {value: code for code, value in enumerate(values)}
+        self.bounds = np.r_[starts, len(sketch)]
+        self.buckets = sketch['bucket'].to_numpy(np.int64)
+        self.counts = sketch['count'].to_numpy(np.int64)
+        self.num_buckets = int(self.buckets.max()) + 1 if len(sketch) else 1
+
+    @classmethod
+    def read(cls, snapshot_dir=None):
+        # The sketches of the live snapshot, or of snapshot_dir
+        return cls(pd.read_feather(f"{snapshot_dir or current_snapshot_dir()}/{SKETCH_FILE}"))
+
+    def merged(self, years=None, months=None, job_classes=None, queue_filter='all', qnames=None):
+        # Waits per bucket of every cell in the selection; None selects every value of a key
+        selected = np.ones(len(self.bounds) - 1, dtype=bool)
+        for column, values in [('year', years), ('month', months), ('job_class', job_classes),
+                               ('queue_filter', [queue_filter]), ('qname', qnames)]:
+            if values is not None:
+                lookup = np.zeros(len(self.codes[column]), dtype=bool)
+                lookup[[self.codes[column][value] for value in values if value in self.codes[column]]] = True
+                selected &= lookup[self.cells[column]]
+        rows = np.repeat(selected, np.diff(self.bounds))
+        return np.bincount(self.buckets[rows], weights=self.counts[rows], minlength=self.num_buckets).astype(np.int64)
+
+    def quantiles(self, quantiles=(0.5, 0.9, 0.99), **selection):
+        # {quantile: waiting time in seconds} and the number of waits of the selection (see merged)
+        counts = self.merged(**selection)
+        return dict(zip(quantiles, sketch_quantiles(counts, quantiles))), int(counts.sum())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Waiting time quantiles of any selection, from the live snapshot.')
+    parser.add_argument('--years', type=int, nargs='+', help='Years (default: all)')
+    parser.add_argument('--months', nargs='+', choices=MONTHS, help='Months, e.g. Jan Feb (default: all)')
+    parser.add_argument('--job-classes', nargs='+', choices=JOB_TYPES, help='Job classes (default: all)')
+    parser.add_argument('--queue-filter', choices=QUEUE_FILTERS, default='all', help='Queue filter of the pages')
+    parser.add_argument('--qnames', nargs='+', help='Queues (default: all)')
+    parser.add_argument('--quantiles', type=float, nargs='+', default=[50, 90, 99], help='Percentiles to print')
+    args = parser.parse_args()
+
+    sketches = WaitSketches.read()
+    values, count = sketches.quantiles([q / 100 for q in args.quantiles], years=args.years, months=args.months,
+                                       job_classes=args.job_classes, queue_filter=args.queue_filter,
+                                       qnames=args.qnames)
+    print(f"{count} jobs (quantiles within {SKETCH_ALPHA:.0%})")
+    for percentile, value in zip(args.quantiles, values.values()):
+        print(f"p{percentile:g}: {value / 60:.1f} min")
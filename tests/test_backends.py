@@ -0,0 +1,56 @@
+# The pandas, arrow and polars backends of GetQueueTime must write the same outputs and state. A small synthetic
+# year keeps this quick; benchmarks/check_backends.py runs the same comparison on a full-size year and times it
+import os
+import sys
+import pytest
+import pandas as pd
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'benchmarks'))
+
+from helpers import read_waiting_times, earlier_years_file, ALL_JOB_DTYPES
+from GetQueueTime import waiting_time_per_job_type, load_state
+from synthetic_accounting import write_synthetic_accounting, synthetic_work_dir
+
+YEAR = 2024
+ROWS = 10_000
+BATCH_ROWS = 3_000
+
+
+@pytest.fixture(scope='module')
+def input_file_name(tmp_path_factory):
+    # A synthetic year, with its queue catalog as QUEUE_INFO_PATH while the tests run
+    with synthetic_work_dir(str(tmp_path_factory.mktemp('accounting'))) as work_dir:
+        file_name = os.path.join(work_dir, f'{YEAR}.feather')
+        write_synthetic_accounting(file_name, ROWS, YEAR)
+        yield file_name
+
+
+def run_backend(backend, input_file_name, output_dir, batch_rows):
+    # One GetQueueTime run with the all_jobs output; returns every output it wrote and its sorted state
+    output_dir.mkdir()
+    output_file_name = str(output_dir / 'waiting_times.feather')
+    all_jobs_file_name = str(output_dir / 'all_jobs.feather')
+    state_file_name = str(output_dir / 'state.feather')
+    waiting_time_per_job_type(input_file_name, output_file_name, YEAR, state_file_name, batch_rows=batch_rows,
+                              backend=backend, extra_outputs={'all_jobs': all_jobs_file_name})
+    return {
+        'output': read_waiting_times(output_file_name),
+        'earlier_years': read_waiting_times(earlier_years_file(output_file_name, YEAR)),
+        'all_jobs': read_waiting_times(all_jobs_file_name, dtypes=ALL_JOB_DTYPES),
+        'state': load_state(state_file_name)[0].astype(str).sort_values(['owner', 'job_type'], ignore_index=True),
+    }
+
+
+@pytest.mark.parametrize('batch_rows', [None, BATCH_ROWS])
+@pytest.mark.parametrize('backend', ['arrow', 'polars'])
+def test_backend_matches_pandas(backend, batch_rows, input_file_name, tmp_path):
+    if backend == 'polars':
+        pytest.importorskip('polars')
+    expected = run_backend('pandas', input_file_name, tmp_path / 'pandas', batch_rows)
+    actual = run_backend(backend, input_file_name, tmp_path / backend, batch_rows)
+    assert len(expected['output']) and len(expected['all_jobs']) > len(expected['output'])
+    for name, frame in expected.items():
+        # Categoricals are compared by value: the backends can number the categories in another order
+        pd.testing.assert_frame_equal(actual[name], frame, check_categorical=False, obj=name)